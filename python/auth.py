@@ -1,14 +1,23 @@
 import json
-import copy
 import hashlib
 import time
 import string
 import random
-from hmac import HMAC
+import struct
+from hmac import HMAC, compare_digest
 from twisted.web import resource
 
 
 class TransportWrapper(object):
+    '''
+    Signs and verifies messages with a HMAC of the group key.
+
+    Two envelopes are supported:
+    "json" (legacy): {"raw": "<JSON>", "hash": "<HMAC>"}
+    "compact": <HMAC>\n<JSON>
+    decapsulate tells them apart by the first character.
+    '''
+    envelopes = ("json", "compact")
 
     def __init__(self, key):
         if key is None:
@@ -17,39 +26,175 @@ class TransportWrapper(object):
             self.key = key.encode('utf-8')
 
         self.digestmod = hashlib.sha256
+        # Keyed state, copied for every message instead of
+        # hashing the key over and over again
+        self.hmac = HMAC(self.key, digestmod=self.digestmod)
         self.charset = [x for x in string.printable.strip()]
 
     def makeChallenge(self):
         return "".join(random.sample(self.charset, 32))
 
-    def encapsulate(self, challenge, message):
+    def sign(self, raw):
+        hmac = self.hmac.copy()
+        hmac.update(raw)
+        return hmac.hexdigest()
+
+    def wrap(self, clone, envelope):
+        raw = json.dumps(clone)
+        hashsum = self.sign(raw.encode('utf-8'))
+
+        if envelope == "compact":
+            return hashsum + "\n" + raw
+        return json.dumps({"raw": raw, "hash": hashsum})
+
+    def unwrap(self, message):
+        '''
+        Verifies the signature of a message in either
+        envelope, returns the message dict or False.
+        '''
+        if message[:1] == b"{":
+            packet = json.loads(message.decode('utf-8'))
+            if 'raw' not in packet or 'hash' not in packet:
+                raise AttributeError("Packet malformatted")
+            raw = packet['raw'].encode('utf-8')
+            received = packet['hash'].encode('utf-8')
+        else:
+            (received, sep, raw) = message.partition(b"\n")
+            if not sep:
+                raise AttributeError("Packet malformatted")
+
+        hashsum = self.sign(raw).encode('ascii')
+        if not compare_digest(hashsum, received):
+            return False
+
+        return json.loads(raw.decode('utf-8'))
+
+    def encapsulate(self, challenge, message, envelope="json"):
         assert(type(message) is dict)
-        clone = copy.deepcopy(message)
+        # Only top level keys are added, a shallow copy is enough
+        clone = dict(message)
         clone['_time'] = time.time()
         clone['challenge'] = challenge
-        raw = json.dumps(clone).encode('utf-8')
-        hashsum = HMAC(self.key, msg=raw, digestmod=self.digestmod).hexdigest()
-
-        return json.dumps({"raw": raw.decode('utf-8'), "hash": hashsum})
+        return self.wrap(clone, envelope)
 
     def decapsulate(self, message, challenge):
         # assert(type(message) is str)
-        packet = json.loads(message.decode('utf-8'))
-        if 'raw' not in packet or 'hash' not in packet:
-            raise AttributeError("Packet malformatted")
-
-        hashsum = HMAC(self.key, msg=packet['raw'].encode('utf-8'),
-                       digestmod=self.digestmod).hexdigest()
-
-        if not (hashsum == packet['hash']):
+        raw_pkt = self.unwrap(message)
+        if raw_pkt is False:
             return False
 
-        raw_pkt = json.loads(packet['raw'])
         if raw_pkt['challenge'] != challenge:
             raise ValueError("Challenge mismatch")
 
         return raw_pkt
 
+    def seal(self, message, seq, instance, envelope="json"):
+        '''
+        Signs a message without a challenge, so it can be
+        handed out to any number of clients. Freshness is
+        proven by the server time and a sequence number
+        increasing within the server instance.
+        '''
+        assert(type(message) is dict)
+        clone = dict(message)
+        clone['_time'] = time.time()
+        clone['seq'] = seq
+        clone['instance'] = instance
+        return self.wrap(clone, envelope)
+
+    def unseal(self, message, window, last=None, offset=0):
+        '''
+        Verifies a sealed message. It is only accepted if its
+        time is within window seconds of ours and, if last
+        (a previously accepted message) is given, it is not
+        older than that one.
+        Needs the clocks of both sides to be in sync, or their
+        offset (sender minus ours) to be known.
+        '''
+        raw_pkt = self.unwrap(message)
+        if raw_pkt is False:
+            return False
+
+        if abs(time.time() + offset - raw_pkt['_time']) > window:
+            raise ValueError("Message outside of time window")
+        if last is not None and raw_pkt['instance'] == last['instance']:
+            if (raw_pkt['seq'], raw_pkt['_time']) < (last['seq'], last['_time']):
+                raise ValueError("Sequence regressed")
+
+        return raw_pkt
+
+
+class DatagramWrapper(object):
+    '''
+    Packs the state of a traffic light into fixed size,
+    HMAC authenticated datagrams.
+
+    Instead of challenges, every sender numbers its datagrams
+    within a random session. Receivers only accept sequence
+    numbers higher than the last one seen.
+    '''
+    magic = b"TLU1"
+    # magic, session, sequence, state, flags, battery voltage, 3 lamp currents
+    layout = struct.Struct("!4sIIBBf3H")
+    digest_size = 16
+    size = layout.size + digest_size
+
+    GOOD = 1
+    GIVE_WAY = 2
+    TEMP_ERROR = 4
+
+    def __init__(self, key):
+        if key is None:
+            self.key = bytes()
+        else:
+            self.key = key.encode('utf-8')
+
+        self.digestmod = hashlib.sha256
+        self.hmac = HMAC(self.key, digestmod=self.digestmod)
+
+    def sign(self, raw):
+        hmac = self.hmac.copy()
+        hmac.update(raw)
+        return hmac.digest()[:self.digest_size]
+
+    def pack(self, session, seq, message):
+        flags = 0
+        if message["good"] is True:
+            flags |= self.GOOD
+        if message["give_way"]:
+            flags |= self.GIVE_WAY
+        if message["temp_error"]:
+            flags |= self.TEMP_ERROR
+        currents = [min(max(int(x), 0), 0xffff) for x in message["lamp_currents"][:3]]
+        raw = self.layout.pack(self.magic, session, seq & 0xffffffff,
+                               int(message["state"]), flags,
+                               float(message["batt_voltage"]), *currents)
+        return raw + self.sign(raw)
+
+    def unpack(self, packet):
+        '''
+        Returns a tuple of session, sequence number and the
+        message dict, raises ValueError if the packet is
+        malformed or not authentic.
+        '''
+        if len(packet) != self.size:
+            raise ValueError("Packet size mismatch")
+        raw = packet[:self.layout.size]
+        if not compare_digest(self.sign(raw), packet[self.layout.size:]):
+            raise ValueError("Signature mismatch")
+        (magic, session, seq, state, flags, batt_voltage,
+         red, yellow, green) = self.layout.unpack(raw)
+        if magic != self.magic:
+            raise ValueError("Unknown packet type")
+        message = {"state": state,
+                   "batt_voltage": batt_voltage,
+                   "lamp_currents": [red, yellow, green],
+                   "good": bool(flags & self.GOOD),
+                   "give_way": bool(flags & self.GIVE_WAY),
+                   "temp_error": bool(flags & self.TEMP_ERROR),
+                   }
+        return (session, seq, message)
+
 
 class Authenticator(resource.Resource, TransportWrapper):
     isLeaf = True
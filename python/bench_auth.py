@@ -0,0 +1,44 @@
+'''
+Microbenchmark of auth.TransportWrapper.
+
+Measures encapsulate/decapsulate throughput of both
+envelopes with a typical traffic light state, e.g.
+
+    python3 bench_auth.py -n 20000
+'''
+import argparse
+import timeit
+from auth import TransportWrapper
+
+message = {"state": 3,
+           "batt_voltage": 1254,
+           "lamp_currents": [0, 0, 612],
+           "good": True,
+           "give_way": True,
+           "temp_error": False,
+           }
+
+
+def run(number, repeat, key):
+    wrapper = TransportWrapper(key)
+    challenge = wrapper.makeChallenge()
+    print("{:10} {:>14} {:>14}".format("envelope", "encap/s", "decap/s"))
+    for envelope in TransportWrapper.envelopes:
+        packet = wrapper.encapsulate(challenge, message, envelope).encode('utf-8')
+        encap = min(timeit.repeat(lambda: wrapper.encapsulate(challenge, message, envelope),
+                                  number=number, repeat=repeat))
+        decap = min(timeit.repeat(lambda: wrapper.decapsulate(packet, challenge),
+                                  number=number, repeat=repeat))
+        print("{:10} {:14.0f} {:14.0f}".format(envelope, number / encap, number / decap))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=10000,
+                        help="operations per measurement")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="measurements, the best one is reported")
+    parser.add_argument("-k", "--key", default="sdicoewfoew4t03iner",
+                        help="group key")
+    args = parser.parse_args()
+    run(args.number, args.repeat, args.key)
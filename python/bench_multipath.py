@@ -0,0 +1,296 @@
+'''
+Multi-path polling benchmark.
+
+Runs two instances of main.py on loopback with dummy lights.
+The first polls the second through several local proxies
+standing in for different networks, each with its own delay
+and loss. The phases make the first path jittery, lossy and,
+after a clean phase again, dead, e.g.
+
+    python3 bench_multipath.py --paths 2
+    python3 bench_multipath.py --paths 1 --mode longpoll
+
+For each phase "fresh" is the share of samples in which the
+remote light was seen within --fresh seconds, "age" the
+distribution of the time since it was seen. "good" is the
+share of samples in which the group was good, "detect" the
+time from the start of the phase until it was not. Wins, hedged
+requests, requests overtaken on another path ("late") and
+timeouts are counted per path.
+'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bench_switchover import summary
+
+config = '''[web]
+http_port={port}
+apikey=SomeRandomStuff
+
+[group]
+type=group
+i_am_master={master}
+local=local_light
+remote=remote_light
+group_key={key}
+
+[local_light]
+type=dummy
+fail_probability=0
+
+[remote_light]
+type=remote
+url={url}
+interval={interval}
+mode={mode}
+timeout={timeout}
+maxage_min={maxage_min}
+maxage_max={maxage_max}
+'''
+
+# Headers passed on by the proxies
+forwarded = ("content-type", "x-state-version", "x-held")
+
+
+class Proxy(ThreadingHTTPServer):
+    '''
+    Forwards requests to upstream after delay seconds (plus up
+    to jitter), lost requests are never answered. Each request
+    may stall the proxy with probability stall, then all
+    requests wait for up to spike seconds, like on a congested
+    link.
+    '''
+    daemon_threads = True
+
+    def __init__(self, port, upstream):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), ProxyHandler)
+        self.upstream = upstream
+        self.delay = 0
+        self.jitter = 0
+        self.loss = 0
+        self.stall = 0
+        self.spike = 0
+        self.stalled_until = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def set(self, delay, jitter, loss, stall=0, spike=0):
+        (self.delay, self.jitter, self.loss) = (delay, jitter, loss)
+        (self.stall, self.spike) = (stall, spike)
+
+    def handle_error(self, request, client_address):
+        # Clients cancel requests answered on another path
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def stop(self):
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        proxy = self.server
+        if random.random() < proxy.loss:
+            # Until the client gives up and closes the connection
+            proxy.stopped.wait(60)
+            self.close_connection = True
+            return
+        now = time.monotonic()
+        if random.random() < proxy.stall:
+            proxy.stalled_until = max(proxy.stalled_until, now + random.uniform(0, proxy.spike))
+        time.sleep(max(0, proxy.stalled_until - now) + proxy.delay + random.uniform(0, proxy.jitter))
+        try:
+            with urllib.request.urlopen(proxy.upstream + self.path, timeout=60) as f:
+                (status, headers, body) = (f.status, f.headers, f.read())
+        except urllib.error.HTTPError as e:
+            (status, headers, body) = (e.code, e.headers, e.read())
+        except OSError:
+            self.close_connection = True
+            return
+        self.send_response(status)
+        for name in forwarded:
+            if headers.get(name) is not None:
+                self.send_header(name, headers.get(name))
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Instance(object):
+    '''
+    main.py running with a generated config.
+    '''
+
+    def __init__(self, directory, name, **options):
+        self.port = options["port"]
+        path = os.path.join(directory, name + ".conf")
+        with open(path, "w") as f:
+            f.write(config.format(**options))
+        self.log = open(os.path.join(directory, name + ".log"), "w")
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.process = subprocess.Popen([sys.executable, "main.py", path], cwd=here,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    def stats(self, name, path="/stats"):
+        url = "http://127.0.0.1:{}/interface/{}{}".format(self.port, name, path)
+        try:
+            with urllib.request.urlopen(url, timeout=.5) as f:
+                return json.loads(f.read().decode('utf8'))
+        except (OSError, ValueError):
+            return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+def phases(args):
+    '''
+    Name and (delay, jitter, loss[, stall, spike]) of each
+    proxy per phase.
+    '''
+    good = (args.delay, args.jitter, 0)
+    others = [good] * (args.paths - 1)
+    return [("clean", [good] + others),
+            ("jitter", [(args.delay, args.jitter, 0, args.stall, args.spike)] + others),
+            ("lossy", [(args.delay, args.jitter, args.loss)] + others),
+            ("clean", [good] + others),
+            ("dead", [(0, 0, 1)] + others),
+            ]
+
+
+def counters(stats):
+    return [{k: path[k] for k in ("wins", "hedged", "late", "timeouts", "errors", "requests")}
+            for path in stats["paths"]]
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix="bench_multipath-")
+    polled = "http://127.0.0.1:{}".format(args.port + 1)
+    proxies = [Proxy(args.port + 2 + i, polled) for i in range(args.paths)]
+    common = {"key": args.key, "interval": args.interval, "mode": args.mode, "timeout": args.timeout,
+              "maxage_min": args.maxage_min, "maxage_max": args.maxage_max}
+    url = " ".join("http://127.0.0.1:{}/interface/local_light".format(x.server_address[1])
+                   for x in proxies)
+    instances = [Instance(directory, "client", port=args.port, master=True, url=url, **common),
+                 Instance(directory, "server", port=args.port + 1, master=False,
+                          url="http://127.0.0.1:{}/interface/local_light".format(args.port), **common)]
+    results = []
+    try:
+        deadline = time.monotonic() + args.startup
+        while time.monotonic() < deadline:
+            stats = instances[0].stats("remote_light")
+            if stats is not None and stats["age"] < args.fresh:
+                break
+            time.sleep(.2)
+        else:
+            raise RuntimeError("Remote light not seen, see logs in {}".format(directory))
+        for (name, settings) in phases(args):
+            for (proxy, setting) in zip(proxies, settings):
+                proxy.set(*setting)
+            before = counters(instances[0].stats("remote_light"))
+            ages = []
+            goods = []
+            detect = None
+            started = time.monotonic()
+            while time.monotonic() < started + args.phase:
+                stats = instances[0].stats("remote_light")
+                if stats is not None:
+                    ages.append(stats["age"])
+                status = instances[0].stats("group", "")
+                if status is not None:
+                    goods.append(status["good"] is True)
+                    if detect is None and status["good"] is not True:
+                        detect = time.monotonic() - started
+                time.sleep(args.sample)
+            after = counters(instances[0].stats("remote_light"))
+            paths = [{k: new[k] - old[k] for k in new} for (old, new) in zip(before, after)]
+            results.append({"phase": name,
+                            "fresh": sum(1 for x in ages if x < args.fresh) / float(len(ages)),
+                            "age": summary(ages),
+                            "good": sum(goods) / float(len(goods)),
+                            "detect": detect,
+                            "paths": paths,
+                            })
+    finally:
+        for instance in instances:
+            instance.stop()
+        for proxy in proxies:
+            proxy.stop()
+    return {"parameters": {"paths": args.paths, "mode": args.mode, "interval": args.interval,
+                           "timeout": args.timeout, "delay": args.delay, "jitter": args.jitter,
+                           "loss": args.loss, "stall": args.stall, "spike": args.spike, "phase": args.phase,
+                           "maxage_min": args.maxage_min, "maxage_max": args.maxage_max},
+            "phases": results,
+            "logs": directory,
+            }
+
+
+def report(result):
+    print("{} paths, mode {}, interval {}s".format(result["parameters"]["paths"],
+          result["parameters"]["mode"], result["parameters"]["interval"]))
+    print("{:6} {:>6} {:>9} {:>9} {:>6} {:>7}  {}".format("phase", "fresh", "age p50", "age p95",
+          "good", "detect", "per path wins/hedged/late/timeouts"))
+    for phase in result["phases"]:
+        paths = " ".join("{wins}/{hedged}/{late}/{timeouts}".format(**x) for x in phase["paths"])
+        detect = "{:6.1f}s".format(phase["detect"]) if phase["detect"] is not None else "{:>7}".format("-")
+        print("{:6} {:5.1f}% {:8.0f}ms {:8.0f}ms {:5.1f}% {}  {}".format(
+              phase["phase"], 100 * phase["fresh"], phase["age"]["p50"] * 1000,
+              phase["age"]["p95"] * 1000, 100 * phase["good"], detect, paths))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--paths", type=int, default=2, help="number of paths to the remote")
+    parser.add_argument("--mode", default="poll", choices=["poll", "longpoll"],
+                        help="polling mode of the remote light")
+    parser.add_argument("--interval", type=float, default=.5, help="poll interval in seconds")
+    parser.add_argument("--timeout", type=float, default=2, help="request timeout in seconds")
+    parser.add_argument("--delay", type=float, default=.02, help="delay of each proxy in seconds")
+    parser.add_argument("--jitter", type=float, default=.02, help="random extra delay in seconds")
+    parser.add_argument("--stall", type=float, default=.1,
+                        help="probability of a request stalling the first path in the jitter phase")
+    parser.add_argument("--spike", type=float, default=5, help="max. seconds of a stall")
+    parser.add_argument("--maxage-min", type=float, default=4,
+                        help="lower bound of the adaptive maxage of the remote light")
+    parser.add_argument("--maxage-max", type=float, default=8,
+                        help="upper bound of the adaptive maxage, equal bounds fix it")
+    parser.add_argument("--loss", type=float, default=.3,
+                        help="share of lost requests on the first path in the lossy phase")
+    parser.add_argument("--phase", type=float, default=20, help="seconds per phase")
+    parser.add_argument("--sample", type=float, default=.1, help="seconds between samples")
+    parser.add_argument("--fresh", type=float, default=1, help="max. age of a fresh sample in seconds")
+    parser.add_argument("--startup", type=float, default=30,
+                        help="seconds the instances may take to see each other")
+    parser.add_argument("--port", type=int, default=8900,
+                        help="HTTP port of the client, +1 for the polled instance, then the proxies")
+    parser.add_argument("-k", "--key", default="sdicoewfoew4t03iner", help="group key")
+    parser.add_argument("-o", "--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=1)
@@ -0,0 +1,328 @@
+'''
+End-to-end switchover benchmark.
+
+Runs a master and a slave instance of main.py on loopback,
+with pseudo terminals standing in for both PICs and the
+handheld controller of the master. Toggles the handheld
+between G and g and measures when each PIC is told to
+switch, e.g.
+
+    python3 bench_switchover.py -n 50 --mode longpoll -o longpoll.json
+    python3 bench_switchover.py -n 50 --baseline longpoll.json
+
+"local" is the time from the handheld command to the
+master's PIC, "switchover" to the slave's PIC and
+"divergence" the time between both.
+
+With --framing binary the lights use binary frames, the fake
+PICs switch to them when asked like the firmware does. With
+--corrupt some of their status output is garbled. With --push
+the master pushes its commands to the slave.
+'''
+import os
+import sys
+import pty
+import tty
+import json
+import time
+import random
+import select
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from datetime import datetime, timezone
+import framing
+
+config = '''[web]
+http_port={port}
+apikey=SomeRandomStuff
+
+[group]
+type=group
+i_am_master={master}
+local=local_light
+remote=remote_light
+group_key={key}
+{controllers}
+{push}
+
+[local_light]
+type={serial_type}
+port={pic}
+
+[remote_light]
+type=remote
+url=http://127.0.0.1:{peer_port}/interface/local_light
+interval={interval}
+mode={mode}
+auth={auth}
+'''
+
+
+class FakeDevice(object):
+    '''
+    A pseudo terminal, the instance under test opens path.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        (self.master, self.slave) = pty.openpty()
+        # No echo before the instance configures the port
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.buffer = b""
+        self.binary = False
+        self.seq = 0
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def lines(self):
+        try:
+            self.buffer += os.read(self.master, 4096)
+        except OSError:
+            return []
+        lines = self.buffer.split(b"\n")
+        self.buffer = lines.pop()
+        return [x.strip() for x in lines]
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class Instance(object):
+    '''
+    main.py running with a generated config.
+    '''
+
+    def __init__(self, directory, name, **options):
+        self.name = name
+        self.port = options["port"]
+        path = os.path.join(directory, name + ".conf")
+        with open(path, "w") as f:
+            f.write(config.format(**options))
+        self.log = open(os.path.join(directory, name + ".log"), "w")
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.process = subprocess.Popen([sys.executable, "main.py", path], cwd=here,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    def status(self):
+        url = "http://127.0.0.1:{}/interface/group".format(self.port)
+        try:
+            with urllib.request.urlopen(url, timeout=.5) as f:
+                return json.loads(f.read().decode('utf8'))
+        except (OSError, ValueError):
+            return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+class Bench(object):
+
+    # Status of the fake PICs: state, voltage, error, currents
+    status_line = b"3 1250 0 0 0 60\n"
+    status_interval = .25
+
+    def __init__(self, pics, handheld, corrupt=0):
+        self.pics = pics
+        self.handheld = handheld
+        self.corrupt = corrupt
+        self.next_status = 0
+
+    def status(self, pic):
+        if pic.binary:
+            data = framing.encode(3, 1250, 0, [0, 0, 60], pic.seq)
+            pic.seq += 1
+        else:
+            data = self.status_line
+        if random.random() < self.corrupt:
+            data = bytearray(data)
+            data[random.randrange(len(data))] ^= 1 << random.randrange(8)
+            data = bytes(data)
+        return data
+
+    def pump(self, until, wanted=None):
+        '''
+        Serves the fake devices until the time until or until
+        each PIC in wanted (PIC -> line) received its line.
+        Returns the times the wanted lines arrived.
+        '''
+        wanted = dict(wanted or {})
+        arrived = {}
+        devices = {x.master: x for x in self.pics + [self.handheld]}
+        while True:
+            now = time.monotonic()
+            if now >= until or (wanted and len(arrived) == len(wanted)):
+                return arrived
+            if now >= self.next_status:
+                for pic in self.pics:
+                    pic.write(self.status(pic))
+                self.next_status = now + self.status_interval
+            timeout = max(0, min(until, self.next_status) - now)
+            (readable, w, x) = select.select(list(devices), [], [], timeout)
+            now = time.monotonic()
+            for fd in readable:
+                device = devices[fd]
+                for line in device.lines():
+                    if line in (b"b", b"t"):
+                        device.binary = line == b"b"
+                    if device in wanted and device not in arrived and line == wanted[device]:
+                        arrived[device] = now
+
+    def wait_good(self, instances, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.pump(time.monotonic() + .5)
+            states = [x.status() for x in instances]
+            if all(x is not None and x["good"] is True for x in states):
+                return True
+        return False
+
+
+def percentile(values, p):
+    '''
+    Nearest-rank percentile of sorted values.
+    '''
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100. * len(values) + .5)) - 1))
+    return values[index]
+
+
+def summary(values):
+    values = sorted(values)
+    return {"count": len(values),
+            "min": values[0] if values else None,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else None,
+            "samples": values,
+            }
+
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    pic_master = FakeDevice("pic_master")
+    pic_slave = FakeDevice("pic_slave")
+    handheld = FakeDevice("handheld")
+    directory = tempfile.mkdtemp(prefix="bench_switchover-")
+    common = {"key": args.key, "interval": args.interval, "mode": args.mode, "auth": args.auth,
+              "serial_type": "serial_binary" if args.framing == "binary" else "serial"}
+    instances = [Instance(directory, "master", port=args.port, peer_port=args.port + 1,
+                          master=True, pic=pic_master.path,
+                          controllers="controllers=" + handheld.path,
+                          push="push=http://127.0.0.1:{}/interface/remote_light".format(args.port + 1)
+                          if args.push else "", **common),
+                 Instance(directory, "slave", port=args.port + 1, peer_port=args.port,
+                          master=False, pic=pic_slave.path, controllers="", push="", **common)]
+    bench = Bench([pic_master, pic_slave], handheld, args.corrupt)
+    results = {"local": [], "switchover": [], "divergence": []}
+    failures = 0
+    try:
+        if not bench.wait_good(instances, args.startup):
+            raise RuntimeError("Instances did not get good, see logs in {}".format(directory))
+        # Lights start giving way
+        command = b"g"
+        for i in range(args.number):
+            started = time.monotonic()
+            handheld.write(command + b"\r\n")
+            arrived = bench.pump(started + args.timeout, {pic_master: command, pic_slave: command})
+            if len(arrived) < 2:
+                failures += 1
+                print("{:4d} {}: timed out".format(i, command.decode('ascii')))
+            else:
+                local = arrived[pic_master] - started
+                switchover = arrived[pic_slave] - started
+                results["local"].append(local)
+                results["switchover"].append(switchover)
+                results["divergence"].append(arrived[pic_slave] - arrived[pic_master])
+                if args.verbose:
+                    print("{:4d} {}: local {:.4f}s switchover {:.4f}s".format(
+                          i, command.decode('ascii'), local, switchover))
+            command = b"G" if command == b"g" else b"g"
+            # Random pause, so switching is not in phase with polling
+            bench.pump(time.monotonic() + random.uniform(args.pause / 2, args.pause))
+    finally:
+        for instance in instances:
+            instance.stop()
+        for device in (pic_master, pic_slave, handheld):
+            device.close()
+    return {"version": version(),
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "parameters": {"number": args.number, "mode": args.mode, "auth": args.auth,
+                           "interval": args.interval, "pause": args.pause,
+                           "framing": args.framing, "corrupt": args.corrupt,
+                           "push": args.push},
+            "failures": failures,
+            "results": {name: summary(values) for (name, values) in results.items()},
+            "logs": directory,
+            }
+
+
+def report(result, baseline=None):
+    print("{} switches, {} failed, mode {}, interval {}s".format(
+          result["parameters"]["number"], result["failures"],
+          result["parameters"]["mode"], result["parameters"]["interval"]))
+    print("{:12} {:>9} {:>9} {:>9} {:>9}".format("ms", "p50", "p95", "p99", "max"))
+    for name in ("local", "switchover", "divergence"):
+        values = result["results"][name]
+        row = ["{:9.1f}".format(values[k] * 1000) if values[k] is not None else "{:>9}".format("-")
+               for k in ("p50", "p95", "p99", "max")]
+        print("{:12} {}".format(name, " ".join(row)))
+        if baseline is None or name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]
+        row = ["{:+8.0f}%".format(100. * (values[k] - old[k]) / old[k]) if values[k] and old[k]
+               else "{:>9}".format("-") for k in ("p50", "p95", "p99", "max")]
+        print("{:12} {}".format("  vs " + str(baseline.get("version")), " ".join(row)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=20, help="switches to measure")
+    parser.add_argument("--mode", default="poll", choices=["poll", "longpoll"],
+                        help="polling mode of the remote lights")
+    parser.add_argument("--auth", default="challenge", choices=["challenge", "window"])
+    parser.add_argument("--framing", default="text", choices=["text", "binary"],
+                        help="serial protocol of the lights")
+    parser.add_argument("--corrupt", type=float, default=0,
+                        help="probability of a garbled status output of the fake PICs")
+    parser.add_argument("--push", action="store_true", help="master pushes its commands to the slave")
+    parser.add_argument("--interval", type=float, default=.5, help="poll interval in seconds")
+    parser.add_argument("--pause", type=float, default=2, help="max. seconds between switches")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds until a switch failed")
+    parser.add_argument("--startup", type=float, default=30,
+                        help="seconds the instances may take to get good")
+    parser.add_argument("--port", type=int, default=8890, help="HTTP port of the master, +1 for the slave")
+    parser.add_argument("-k", "--key", default="sdicoewfoew4t03iner", help="group key")
+    parser.add_argument("-o", "--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare with results written earlier")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every switch")
+    args = parser.parse_args()
+
+    result = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=1)
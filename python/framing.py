@@ -0,0 +1,109 @@
+import struct
+import binascii
+from twisted.internet import protocol
+
+# Frame: sync, length of the payload, payload, CRC-16/CCITT
+# (initial value 0xffff) of length and payload, little endian.
+sync = b"\xa5\x5a"
+# state, battery voltage (1/100 V), error state bits,
+# red, yellow and green lamp current, sequence number
+payload = struct.Struct("<BHHHHHB")
+crc = struct.Struct("<H")
+# Longer payloads are accepted, later firmware may append fields
+max_length = 64
+
+
+def checksum(data):
+    return binascii.crc_hqx(data, 0xffff)
+
+
+def encode(state, batt_voltage, error_state, currents, seq):
+    '''
+    Builds a frame as sent by the PIC (see pic/ampel.jal).
+    '''
+    body = bytes([payload.size]) + payload.pack(state, batt_voltage, error_state,
+                                                currents[0], currents[1], currents[2],
+                                                seq & 0xff)
+    return sync + body + crc.pack(checksum(body))
+
+
+class FrameReceiver(protocol.Protocol):
+    '''
+    Parses binary frames from a byte stream.
+
+    Received data is collected in one buffer, fields are
+    unpacked from it in place and the buffer is only shortened
+    once per chunk of data. After corruption (bad length or
+    CRC) the search for the next sync starts one byte behind
+    the bad one, so no valid frame is lost.
+
+    Text lines between frames, e.g. from firmware not (yet) in
+    binary mode, are passed to textLineReceived.
+    '''
+    frames_received = 0
+    frames_garbled = 0
+    frame_buffer = None
+
+    def frameReceived(self, buffer, offset, length):
+        '''
+        Called with the buffer, offset and length of the payload
+        of each valid frame. The buffer is only valid during the
+        call.
+        '''
+        raise NotImplementedError
+
+    def textLineReceived(self, line):
+        pass
+
+    def dataReceived(self, data):
+        if self.frame_buffer is None:
+            self.frame_buffer = bytearray()
+        buffer = self.frame_buffer
+        buffer += data
+        pos = 0
+        size = len(buffer)
+        while True:
+            start = buffer.find(sync, pos)
+            if start < 0:
+                pos += self.skipped(buffer, pos, size, final=False)
+                break
+            if start > pos:
+                self.skipped(buffer, pos, start, final=True)
+            pos = start
+            if size - start < 3:
+                break
+            length = buffer[start + 2]
+            if length < payload.size or length > max_length:
+                self.frames_garbled += 1
+                pos = start + 1
+                continue
+            end = start + 3 + length + crc.size
+            if size < end:
+                break
+            with memoryview(buffer) as view:
+                valid = checksum(view[start + 2:end - crc.size]) == crc.unpack_from(buffer, end - crc.size)[0]
+            if not valid:
+                self.frames_garbled += 1
+                pos = start + 1
+                continue
+            self.frames_received += 1
+            self.frameReceived(buffer, start + 3, length)
+            pos = end
+        del buffer[:pos]
+
+    def skipped(self, buffer, start, end, final):
+        '''
+        Handles bytes outside of frames, returns the number of
+        bytes consumed. Unless final, an incomplete last line
+        is kept as it may continue (or start a sync).
+        '''
+        if start == end:
+            return 0
+        chunk = bytes(buffer[start:end])
+        lines = chunk.split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            self.textLineReceived(line)
+        if final or len(rest) > max_length * 4:
+            return len(chunk)
+        return len(chunk) - len(rest)
@@ -0,0 +1,155 @@
+import os
+import stat
+import fnmatch
+from twisted.python import log
+from twisted.python.filepath import FilePath
+from monitor import TimedLoopingCall
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    # Not on Linux, use polling instead
+    inotify = None
+
+
+class ControllerDiscovery(object):
+    '''
+    Watches /dev for serial devices appearing and vanishing
+    and attaches handheld controllers to a group.
+
+    Uses inotify where available, otherwise the candidate
+    paths are checked every poll_interval seconds. Either
+    way the group is only bothered when something changed.
+
+    A device is only claimed if it is not in use as a serial
+    traffic light and, if usb_id ("VENDOR:PRODUCT", hex) is
+    given, it belongs to a USB device with this id.
+    '''
+
+    def __init__(self, group, candidates, usb_id=None, poll_interval=2,
+                 claimed=()):
+        self.group = group
+        self.logger = group.logger
+        self.candidates = list(candidates)
+        self.usb_id = usb_id.lower() if usb_id else None
+        self.poll_interval = poll_interval
+        self.claimed = claimed
+        self.present = set()
+        self.notifier = None
+        self.poll_loop = None
+
+    def start(self):
+        directories = set(os.path.dirname(x) for x in self.candidates)
+        if inotify is not None:
+            try:
+                self.notifier = inotify.INotify()
+                self.notifier.startReading()
+                mask = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_ATTRIB
+                for directory in directories:
+                    self.notifier.watch(FilePath(directory), mask=mask,
+                                        callbacks=[self.on_notify])
+            except Exception as e:
+                self.logger.warning("inotify not usable, fall back to polling: {}".format(e))
+                self.notifier = None
+        if self.notifier is None:
+            self.poll_loop = TimedLoopingCall(self.scan)
+            self.poll_loop.start(self.poll_interval, now=False).addErrback(log.err)
+        self.scan()
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+        if self.poll_loop is not None and self.poll_loop.running:
+            self.poll_loop.stop()
+
+    def isCandidate(self, path):
+        return any(fnmatch.fnmatch(path, x) for x in self.candidates)
+
+    def on_notify(self, ignored, filepath, mask):
+        path = filepath.asTextMode().path
+        if not self.isCandidate(path):
+            return
+        if mask & inotify.IN_DELETE:
+            self.removed(path)
+        else:
+            # udev creates the node first and sets permissions
+            # afterwards, so an attribute change may be the first
+            # time the device can be opened.
+            self.added(path)
+
+    def scan(self):
+        '''
+        Compares the candidate paths present now with the last
+        scan and handles the differences.
+        '''
+        present = set()
+        for pattern in self.candidates:
+            if any(c in pattern for c in "*?["):
+                directory = os.path.dirname(pattern)
+                try:
+                    names = os.listdir(directory)
+                except OSError:
+                    continue
+                present.update(os.path.join(directory, x) for x in names
+                               if fnmatch.fnmatch(os.path.join(directory, x), pattern))
+            elif os.path.exists(pattern):
+                present.add(pattern)
+        for path in self.present - present:
+            self.removed(path)
+        # Retry devices already present while nothing is attached
+        for path in sorted(present):
+            self.added(path)
+
+    def added(self, path):
+        self.present.add(path)
+        if self.group.controller is not None:
+            return
+        if not self.identify(path):
+            return
+        self.group.attachController(path)
+
+    def removed(self, path):
+        self.present.discard(path)
+        controller = self.group.controller
+        if controller is not None and controller.port == path:
+            self.logger.info("Controller {} removed".format(path))
+            controller.serial.loseConnection()
+
+    def identify(self, path):
+        '''
+        Tells if path is a handheld controller.
+        '''
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            return False
+        if not stat.S_ISCHR(mode):
+            return False
+        real = os.path.realpath(path)
+        if real in [os.path.realpath(x) for x in self.claimed]:
+            self.logger.debug("'{}' is in use as traffic light".format(path))
+            return False
+        if self.usb_id is not None:
+            found = self.usbId(real)
+            if found != self.usb_id:
+                self.logger.debug("'{}' has USB id {}, not a controller".format(path, found))
+                return False
+        return True
+
+    def usbId(self, path):
+        '''
+        Looks up "VENDOR:PRODUCT" of the USB device behind
+        a tty in sysfs, None if there is none.
+        '''
+        device = os.path.realpath("/sys/class/tty/{}/device".format(os.path.basename(path)))
+        while device != "/":
+            try:
+                with open(os.path.join(device, "idVendor")) as f:
+                    vendor = f.read().strip()
+                with open(os.path.join(device, "idProduct")) as f:
+                    product = f.read().strip()
+                return "{}:{}".format(vendor, product).lower()
+            except (IOError, OSError):
+                device = os.path.dirname(device)
+        return None
@@ -0,0 +1,175 @@
+import os
+import json
+import glob
+import struct
+import logging
+from time import time, strftime, gmtime
+from twisted.python import log
+from monitor import TimedLoopingCall
+
+
+# Record kinds
+SAMPLE = 0
+GIVE_WAY = 1
+TEMP_ERROR = 2
+DIVERGE_START = 3
+DIVERGE_END = 4
+CONTROLLER_ATTACH = 5
+CONTROLLER_DETACH = 6
+
+kinds = {SAMPLE: "sample",
+         GIVE_WAY: "give_way",
+         TEMP_ERROR: "temp_error",
+         DIVERGE_START: "diverge_start",
+         DIVERGE_END: "diverge_end",
+         CONTROLLER_ATTACH: "controller_attach",
+         CONTROLLER_DETACH: "controller_detach",
+         }
+
+magic = b"TLJ1"
+# magic, length of the JSON header following
+header = struct.Struct("<4sI")
+# time, source, kind, state, value/flags, battery voltage, 3 lamp currents
+record = struct.Struct("<dHBBBf3Hx")
+
+# Flags of samples
+GOOD = 1
+GIVE_WAY_FLAG = 2
+TEMP_ERROR_FLAG = 4
+
+
+def clamp_state(state):
+    try:
+        return min(max(int(state), 0), 255)
+    except (ValueError, TypeError):
+        return 255
+
+
+class Journal(object):
+    '''
+    Append-only binary journal of light samples and group
+    decisions, for finding out what happened at a site.
+
+    Every file starts with a header naming the sources,
+    followed by fixed size records (see journal_reader.py).
+    Records are collected in memory and written every
+    flush_interval seconds, so the SD card is not written
+    on every change. Files are rotated when they exceed
+    max_size bytes, only the newest keep files are kept.
+    '''
+
+    @classmethod
+    def open(cls, directory, max_size=4*1024*1024, keep=50, flush_interval=10):
+        return cls(directory, int(max_size), int(keep), float(flush_interval))
+
+    def __init__(self, directory, max_size=4*1024*1024, keep=50, flush_interval=10):
+        self.logger = logging.getLogger("journal")
+        self.directory = directory
+        self.max_size = max_size
+        self.keep = keep
+        self.sources = []
+        self.ids = {}
+        self.buffer = bytearray()
+        self.file = None
+        self.size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.flush_loop = TimedLoopingCall(self.flush)
+        self.flush_loop.start(flush_interval, now=False).addErrback(log.err)
+
+    def attach(self, name, light):
+        '''
+        Registers a light as source and records a sample
+        whenever it publishes a change.
+        '''
+        self.ids[id(light)] = len(self.sources)
+        self.sources.append(name)
+        # The header of the current file lacks this source
+        self.rotate()
+        light.setJournal(self)
+        light.subscribe(self.sample)
+
+    def sample(self, light):
+        flags = 0
+        # Liveness as just published, see TrafficLight.publishState
+        if light.published[3] is True:
+            flags |= GOOD
+        if light.give_way:
+            flags |= GIVE_WAY_FLAG
+        if light.temp_error:
+            flags |= TEMP_ERROR_FLAG
+        try:
+            currents = [min(max(int(x), 0), 0xffff) for x in light.lamp_currents[:3]]
+            currents += [0] * (3 - len(currents))
+            batt_voltage = float(light.batt_voltage)
+        except (ValueError, TypeError):
+            return
+        self.add(light, SAMPLE, clamp_state(light.state), flags, batt_voltage, currents)
+
+    def event(self, light, kind, value):
+        '''
+        Records a decision of a light, e.g. a give_way change.
+        '''
+        self.add(light, kind, clamp_state(light.state), int(value), 0., (0, 0, 0))
+
+    def add(self, light, kind, state, value, batt_voltage, currents):
+        if id(light) not in self.ids:
+            return
+        self.buffer += record.pack(time(), self.ids[id(light)], kind, state,
+                                   value, batt_voltage, *currents)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        try:
+            if self.file is None:
+                self.create()
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.size += len(self.buffer)
+        except (IOError, OSError) as e:
+            self.logger.error("Writing journal failed: {}".format(e))
+            return
+        finally:
+            self.buffer = bytearray()
+        if self.size >= self.max_size:
+            self.rotate()
+
+    def create(self):
+        name = "journal-{}.tlj".format(strftime("%Y%m%d-%H%M%S", gmtime()))
+        path = os.path.join(self.directory, name)
+        # Several rotations within a second
+        suffix = 0
+        while os.path.exists(path):
+            suffix += 1
+            path = os.path.join(self.directory, "{}-{}.tlj".format(name[:-4], suffix))
+        content = json.dumps({"sources": self.sources, "kinds": kinds}).encode('utf8')
+        self.file = open(path, "wb")
+        self.file.write(header.pack(magic, len(content)) + content)
+        self.size = header.size + len(content)
+        self.purge()
+
+    def rotate(self):
+        if self.file is None:
+            return
+        buffered = self.buffer
+        self.buffer = bytearray()
+        # Records of the old sources still go into the old file
+        self.file.write(buffered)
+        self.file.close()
+        self.file = None
+
+    def purge(self):
+        files = sorted(glob.glob(os.path.join(self.directory, "journal-*.tlj")),
+                       key=os.path.getmtime)
+        for path in files[:-self.keep]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                self.logger.error("Cannot remove old journal {}: {}".format(path, e))
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
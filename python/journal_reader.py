@@ -0,0 +1,138 @@
+'''
+Reads journals written by journal.Journal.
+
+Files are memory mapped and their fixed size records
+unpacked in bulk, time ranges are found by bisection,
+e.g.
+
+    python3 journal_reader.py /var/lib/ampel --from 2026-10-17T06:00 \\
+        --kind give_way --kind temp_error
+'''
+import os
+import sys
+import glob
+import json
+import mmap
+import argparse
+from datetime import datetime, timezone
+import journal
+
+
+class JournalFile(object):
+    '''
+    A memory mapped journal file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, length) = journal.header.unpack_from(self.map, 0)
+        if magic != journal.magic:
+            raise ValueError("{} is no journal".format(path))
+        start = journal.header.size
+        info = json.loads(self.map[start:start + length].decode('utf8'))
+        self.sources = info["sources"]
+        self.offset = start + length
+        # A partly written last record is ignored
+        self.count = (len(self.map) - self.offset) // journal.record.size
+
+    def time(self, i):
+        return journal.record.unpack_from(self.map, self.offset + i * journal.record.size)[0]
+
+    def bisect(self, t):
+        '''
+        Index of the first record not older than t.
+        '''
+        (low, high) = (0, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            if self.time(middle) < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def records(self, since=None, until=None):
+        first = self.bisect(since) if since is not None else 0
+        last = self.bisect(until) if until is not None else self.count
+        view = memoryview(self.map)[self.offset + first * journal.record.size:
+                                    self.offset + last * journal.record.size]
+        try:
+            for r in journal.record.iter_unpack(view):
+                yield r
+        finally:
+            view.release()
+
+    def close(self):
+        self.map.close()
+
+
+def parse_time(text):
+    try:
+        return float(text)
+    except ValueError:
+        t = datetime.fromisoformat(text)
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=timezone.utc)
+        return t.timestamp()
+
+
+def scan(paths, since=None, until=None, sources=None, kinds=None):
+    '''
+    Yields (time, source name, kind name, state, value,
+    battery voltage, lamp currents) of all matching records.
+    '''
+    for path in paths:
+        f = JournalFile(path)
+        try:
+            wanted = None
+            if sources:
+                wanted = set(i for (i, name) in enumerate(f.sources) if name in sources)
+            for (t, source, kind, state, value, batt, red, yellow, green) in f.records(since, until):
+                if wanted is not None and source not in wanted:
+                    continue
+                if kinds is not None and kind not in kinds:
+                    continue
+                yield (t, f.sources[source], journal.kinds.get(kind, str(kind)),
+                       state, value, batt, (red, yellow, green))
+        finally:
+            f.close()
+
+
+def files(locations):
+    result = []
+    for location in locations:
+        if os.path.isdir(location):
+            result += glob.glob(os.path.join(location, "journal-*.tlj"))
+        else:
+            result.append(location)
+    return sorted(result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("locations", nargs="+", help="journal files or directories")
+    parser.add_argument("--from", dest="since", type=parse_time,
+                        help="unix time or ISO date (UTC if no zone given)")
+    parser.add_argument("--to", dest="until", type=parse_time)
+    parser.add_argument("--source", action="append", help="only these lights")
+    parser.add_argument("--kind", action="append", choices=list(journal.kinds.values()),
+                        help="only these record kinds")
+    parser.add_argument("--count", action="store_true", help="only count records")
+    args = parser.parse_args()
+
+    kinds = None
+    if args.kind:
+        kinds = set(k for (k, name) in journal.kinds.items() if name in args.kind)
+    records = scan(files(args.locations), args.since, args.until, args.source, kinds)
+    if args.count:
+        print(sum(1 for r in records))
+        sys.exit(0)
+    for (t, source, kind, state, value, batt, currents) in records:
+        when = datetime.fromtimestamp(t, timezone.utc).isoformat(timespec="milliseconds")
+        if kind == "sample":
+            print("{} {} {} state={} flags={} batt_voltage={:.2f} lamp_currents={}".format(
+                when, source, kind, state, value, batt, list(currents)))
+        else:
+            print("{} {} {} value={} state={}".format(when, source, kind, value, state))
@@ -0,0 +1,350 @@
+import logging
+from time import time
+from configparser import SafeConfigParser
+from twisted.internet import reactor, defer
+from trafficlight import lightTypes
+from telemetry import TelemetryRing
+from journal import Journal
+from monitor import monitor
+from static import StaticAssets
+from webserver import TrafficLightWeb, TrafficLightStream, TrafficLightsAll, TrafficLightMetrics, TrafficLightMonitor, TrafficLightReload, JSONAnswer
+
+
+class LightConfig(object):
+    '''
+    The lights of a config file and the web tree serving them.
+
+    reload() reads the file again and applies the differences
+    in place: lights of new sections are opened, those of
+    removed sections stopped. Changed options are applied by
+    the light itself where it can (see TrafficLight.retune),
+    otherwise the light is rebuilt. Lights referring to a
+    replaced light are dereferenced again. All other lights,
+    their serial ports and connections keep running.
+
+    The report of a reload tells what was done, how long
+    applying took ("duration") and how long until all affected
+    lights were good again ("settle", None if they weren't
+    within settle_timeout seconds).
+    '''
+    global_sections = ('web', 'journal', 'monitor')
+    settle_timeout = 30
+
+    def __init__(self, path):
+        self.path = path
+        # Name -> light, including members of lights
+        self.lights = {}
+        self.webs = {}
+        # Section -> options as in the config, with type
+        self.sections = {}
+        # Section -> names of its members
+        self.owned = {}
+        self.settings = {}
+        self.journal = None
+        self.interface = None
+        self.stream = None
+        self.keyed = []
+        self.last_reload = None
+
+    def read(self):
+        '''
+        Reads the config, returns the options of the global
+        sections and of the light sections, by section name.
+        '''
+        conf = SafeConfigParser()
+        if not conf.read(self.path):
+            raise ValueError("Cannot read {}".format(self.path))
+        settings = {}
+        sections = {}
+        for s in conf.sections():
+            options = {k: conf.get(s, k) for k in conf.options(s)}
+            if s in self.global_sections:
+                settings[s] = options
+                continue
+            if 'type' not in options:
+                logging.error("{}: No type given, cannot process".format(s))
+                continue
+            options['type'] = options['type'].strip()
+            if options['type'] not in lightTypes:
+                logging.error("{}: Type '{}' is unknown, valid would be {}".format(s,
+                              options['type'], list(lightTypes.keys())))
+                continue
+            sections[s] = options
+        return (settings, sections)
+
+    def port(self):
+        return int(self.settings.get('web', {}).get('http_port', 8880))
+
+    def apikey(self):
+        return self.settings.get('web', {}).get('apikey')
+
+    def open(self, name, options):
+        options = dict(options)
+        lighttype = options.pop('type')
+        logging.info("Start {}".format(name))
+        return lightTypes[lighttype].open(name=name, **options)
+
+    def add(self, name, light):
+        self.lights[name] = light
+        self.owned[name] = []
+        for (member_name, member) in light.members().items():
+            if member_name in self.lights or member_name in self.sections:
+                logging.error("{}: Member {} clashes with another light".format(name, member_name))
+                continue
+            self.lights[member_name] = member
+            self.owned[name].append(member_name)
+
+    def discard(self, name):
+        '''
+        Stops the light of a section, returns the names of it
+        and its members and a Deferred firing once its ports
+        are released.
+        '''
+        light = self.lights.pop(name)
+        stopped = defer.maybeDeferred(light.stop)
+        names = [name] + self.owned.pop(name, [])
+        for member_name in names[1:]:
+            self.lights.pop(member_name, None)
+        for n in names:
+            self.webs.pop(n, None)
+            if bytes(n.encode('ascii')) in self.interface.children:
+                self.interface.delEntity(bytes(n.encode('ascii')))
+        return (names, stopped)
+
+    def serve(self, name):
+        '''
+        Adds a light to the journal and the web tree.
+        '''
+        light = self.lights[name]
+        if self.journal is not None:
+            self.journal.attach(name, light)
+        # Keep a history of each light
+        history = None
+        if light.keep_history:
+            history = TelemetryRing()
+            light.subscribe(history.record)
+        self.webs[name] = TrafficLightWeb(light, history)
+        self.interface.putChild(bytes(name.encode('ascii')), self.webs[name])
+        if name == 'local_light':
+            self.interface.putChild(b"status", TrafficLightWeb(light))
+        if self.stream is not None:
+            self.stream.watch(name, light)
+
+    def start(self):
+        '''
+        Opens all lights and returns the root of the web tree.
+        '''
+        (self.settings, sections) = self.read()
+        self.startMonitor()
+        if 'journal' in self.settings:
+            self.journal = Journal.open(**self.settings['journal'])
+
+        self.sections = dict(sections)
+        for (s, options) in sections.items():
+            try:
+                light = self.open(s, options)
+            except TypeError as e:  # When option name is not known
+                logging.error("{}: {}".format(s, e))
+                del self.sections[s]
+                continue
+            self.add(s, light)
+
+        root = StaticAssets("../website/")
+        self.interface = JSONAnswer(list(self.lights.keys()))
+        root.putChild(b"interface", self.interface)
+        for s in self.lights:
+            # After init, dereference symbolic names
+            self.lights[s].dereference(self.lights)
+            self.serve(s)
+        self.stream = TrafficLightStream(self.lights)
+        self.interface.putChild(b"_stream", self.stream)
+        self.interface.putChild(b"_all", TrafficLightsAll(self.lights))
+        root.putChild(b"metrics", TrafficLightMetrics(self.lights, self.webs))
+        self.keyed = [TrafficLightMonitor(monitor, self.apikey()),
+                      TrafficLightReload(self, self.apikey())]
+        root.putChild(b"monitor", self.keyed[0])
+        root.putChild(b"reload", self.keyed[1])
+        return root
+
+    def startMonitor(self):
+        options = self.settings.get('monitor', {})
+        monitor.start(interval=float(options['interval']) if 'interval' in options else None,
+                      keep=int(options['keep']) if 'keep' in options else None)
+
+    def reload(self):
+        '''
+        Reads the config again and applies the differences.
+        Returns a Deferred firing with the report once the
+        affected lights are good again.
+        '''
+        started = time()
+        report = {"time": started, "added": [], "removed": [], "rebuilt": [],
+                  "retuned": [], "relinked": [], "failed": {}, "restart_needed": []}
+        self.last_reload = report
+        try:
+            (settings, sections) = self.read()
+        except Exception as e:
+            logging.error("Reload failed: {}".format(e))
+            report["error"] = str(e)
+            return defer.succeed(report)
+
+        self.reloadSettings(settings, report)
+        # Names of lights which are gone or were replaced
+        replaced = set()
+        # Released ports of discarded lights, new ones may take them
+        stops = []
+        added = []
+        # Section -> old light, of those to be opened again
+        rebuilds = {}
+        for s in sorted(set(self.sections) - set(sections)):
+            (names, stopped) = self.discard(s)
+            replaced.update(names)
+            stops.append(stopped)
+            del self.sections[s]
+            report["removed"].append(s)
+        for s in sorted(sections):
+            options = sections[s]
+            old = self.sections.get(s)
+            if old == options:
+                continue
+            if old is None:
+                added.append(s)
+                continue
+            changed = {k: v for (k, v) in options.items() if old.get(k) != v}
+            rest = set(k for k in old if k not in options)
+            if old['type'] == options['type'] and not rest:
+                try:
+                    rest = self.lights[s].retune(changed)
+                except ValueError as e:
+                    logging.error("{}: {}".format(s, e))
+                    report["failed"][s] = str(e)
+                    continue
+                if not rest:
+                    self.sections[s] = options
+                    report["retuned"].append(s)
+                    continue
+            rebuilds[s] = self.lights[s]
+            (names, stopped) = self.discard(s)
+            replaced.update(names)
+            stops.append(stopped)
+
+        d = defer.DeferredList(stops, consumeErrors=True)
+        d.addCallback(lambda result: self.reopen(sections, added, rebuilds, replaced, started, report))
+        return d
+
+    def reopen(self, sections, added, rebuilds, replaced, started, report):
+        '''
+        Second half of reload, once the ports of the discarded
+        lights are released: opens new and rebuilt lights and
+        dereferences those affected.
+        '''
+        for s in added:
+            try:
+                light = self.open(s, sections[s])
+            except Exception as e:
+                logging.error("{}: {}".format(s, e))
+                report["failed"][s] = str(e)
+                continue
+            self.sections[s] = sections[s]
+            self.add(s, light)
+            replaced.add(s)
+            replaced.update(self.owned[s])
+            report["added"].append(s)
+        for (s, old) in sorted(rebuilds.items()):
+            replaced.update(self.rebuild(s, sections[s], old, report))
+
+        # Lights using replaced ones and retuned lights (e.g.
+        # passing on a new group key) are dereferenced again.
+        for s in sorted(self.lights):
+            light = self.lights[s]
+            fresh = s in replaced
+            if not fresh and s not in report["retuned"] and not replaced.intersection(light.references()):
+                continue
+            try:
+                light.dereference(self.lights)
+            except ValueError as e:
+                logging.error("{}: {}".format(s, e))
+                report["failed"][s] = str(e)
+                continue
+            if fresh:
+                self.serve(s)
+            elif s not in report["retuned"]:
+                report["relinked"].append(s)
+        self.interface.data[:] = list(self.lights.keys())
+        report["duration"] = time() - started
+        logging.info("Reloaded in {:.3f}s: added {}, removed {}, rebuilt {}, retuned {}, relinked {}".format(
+                     report["duration"], report["added"], report["removed"], report["rebuilt"],
+                     report["retuned"], report["relinked"]))
+
+        affected = set(report["added"] + report["rebuilt"] + report["retuned"] + report["relinked"])
+        # Members of those may be affected, e.g. by a new group key
+        for s in list(affected):
+            if s in self.lights:
+                affected.update(self.lights[s].references())
+        d = defer.Deferred()
+        self.settle(sorted(affected & set(self.lights)), started, report, d)
+        return d
+
+    def rebuild(self, name, options, old, report):
+        '''
+        Opens the light of a section again, after the old one
+        was discarded. If the new options fail, the old ones
+        are used again. Returns the names of the lights opened.
+        '''
+        try:
+            light = self.open(name, options)
+            self.sections[name] = options
+            report["rebuilt"].append(name)
+        except Exception as e:
+            logging.error("{}: {}, keeping the old config".format(name, e))
+            report["failed"][name] = str(e)
+            try:
+                light = self.open(name, self.sections[name])
+            except Exception as e:
+                logging.error("{}: Reopening failed: {}".format(name, e))
+                del self.sections[name]
+                return []
+        # Clients see the state versions continue
+        light.version = old.version
+        self.add(name, light)
+        return [name] + self.owned[name]
+
+    def reloadSettings(self, settings, report):
+        for s in self.global_sections:
+            if settings.get(s) != self.settings.get(s):
+                logging.info("Section {} changed".format(s))
+        if settings.get('journal') != self.settings.get('journal'):
+            report["restart_needed"].append("journal")
+        old_web = dict(self.settings.get('web', {}))
+        new_web = dict(settings.get('web', {}))
+        if old_web.pop('apikey', None) != new_web.pop('apikey', None):
+            for resource in self.keyed:
+                resource.key = settings.get('web', {}).get('apikey')
+        if old_web != new_web:
+            report["restart_needed"].append("web")
+        self.settings = settings
+        self.startMonitor()
+
+    def steady(self, light, started):
+        '''
+        Whether a light is good, based on reports received
+        after the reload if it receives any.
+        '''
+        if light.isGood() is not True:
+            return False
+        return light.last_seen == 0 or light.last_seen >= started
+
+    def settle(self, names, started, report, d):
+        pending = [s for s in names if s in self.lights and not self.steady(self.lights[s], started)]
+        if pending and time() - started < self.settle_timeout:
+            reactor.callLater(.1, self.settle, names, started, report, d)
+            return
+        # Lights which failed to open or dereference never settle
+        pending += [s for s in sorted(report["failed"]) if s not in pending]
+        report["settle"] = None if pending else time() - started
+        report["unsettled"] = pending
+        if pending:
+            logging.warning("Not good {}s after reload: {}".format(self.settle_timeout, pending))
+        else:
+            logging.info("Steady {:.3f}s after reload".format(report["settle"]))
+        d.callback(report)
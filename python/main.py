@@ -1,12 +1,10 @@
 import sys
+import signal
 import logging
-from configparser import SafeConfigParser
-from twisted.web.resource import Resource
 from twisted.web.server import Site
 from twisted.internet import reactor, endpoints
-from twisted.web.static import File
-from trafficlight import lightTypes
-from webserver import TrafficLightWeb, JSONAnswer
+from monitor import TimedRequest
+from lightconfig import LightConfig
 
 if len(sys.argv) < 2:
     print("Please start with a config file name")
@@ -15,56 +13,18 @@ if len(sys.argv) < 2:
 logging.basicConfig(level=logging.DEBUG)
 
 
-lights = {}
-conf = SafeConfigParser()
-conf.read(sys.argv[1])
-
-sections = conf.sections()
-
-if 'web' not in sections:
-    port = 8880
-else:
-    port = conf.getint('web', 'http_port')
-
-light_sections = sections[:]
-light_sections.remove('web')
-
-fail = False
-for s in light_sections:
-    o = conf.options(s)
-    if 'type' not in o:
-        logging.error("{}: No type given, cannot process".format(s))
-        continue
-    lighttype = conf.get(s, 'type').strip()
-    if lighttype not in lightTypes:
-        logging.error("{}: Type '{}' is unknown, valid would be {}".format(s,
-                      lighttype, list(lightTypes.keys())))
-        continue
-    options = {k: conf.get(s, k) for k in conf.options(s)}
-    del options['type']
-
-    try:
-        logging.info("Start {}".format(s))
-        l = lightTypes[lighttype].open(name=s, **options)
-    except TypeError as e:  # When option name is not known
-        logging.error("{}: {}".format(s, e))
-        continue
-    lights[s] = l
-
+config = LightConfig(sys.argv[1])
+root = config.start()
+# root.putChild("auth", Authenticator())
 
-root = File("../website/")
-interface = JSONAnswer(list(lights.keys()))
-interface.putChild(b"status", TrafficLightWeb(lights['local_light']))
-root.putChild(b"interface", interface)
+if config.journal is not None:
+    reactor.addSystemEventTrigger('before', 'shutdown', config.journal.close)
 
-for s in lights:
-    # After init, dereference symbolic names
-    lights[s].dereference(lights)
-    # Finally add them to the web tree
-    interface.putChild(bytes(s.encode('ascii')), TrafficLightWeb(lights[s]))
-# root.putChild("auth", Authenticator())
+# Reload the config on SIGHUP (or POST /reload)
+signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(config.reload))
 
 factory = Site(root)
-endpoint = endpoints.TCP4ServerEndpoint(reactor, port)
+factory.requestFactory = TimedRequest
+endpoint = endpoints.TCP4ServerEndpoint(reactor, config.port())
 endpoint.listen(factory)
 reactor.run()
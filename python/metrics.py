@@ -0,0 +1,123 @@
+from bisect import bisect_left
+
+# Bucket bounds in seconds for latencies, from a fast
+# loopback poll up to the longest timeouts.
+latency_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# Name (without prefix) -> (type, help) of all metrics
+# a traffic light may report in TrafficLight.metrics()
+descriptions = {
+    "state_version": ("gauge", "Version of the published state"),
+    "age_seconds": ("gauge", "Time since the light was last seen"),
+    "good": ("gauge", "1 if the light is good"),
+    "web_requests_total": ("counter", "GET requests served for this light"),
+    "poll_requests_total": ("counter", "Requests sent to the remote"),
+    "poll_errors_total": ("counter", "Requests to the remote that failed"),
+    "poll_timeouts_total": ("counter", "Requests to the remote that timed out"),
+    "poll_late_total": ("counter", "Answers discarded as older than a newer answer"),
+    "poll_skipped_total": ("counter", "Polls skipped because too many requests were running"),
+    "poll_hedged_total": ("counter", "Polls sent on another path because the first was slow"),
+    "poll_rtt_seconds": ("histogram", "Round trip time of requests to the remote"),
+    "maxage_seconds": ("gauge", "Age up to which the remote counts as seen"),
+    "clock_offset_seconds": ("gauge", "Clock of the remote minus ours, estimated from its answers"),
+    "push_total": ("counter", "Commands pushed to the slave"),
+    "push_retransmits_total": ("counter", "Pushed commands sent again for lack of acknowledgement"),
+    "push_failed_total": ("counter", "Pushed commands never acknowledged"),
+    "push_ack_seconds": ("histogram", "Time from pushing a command until the slave acknowledged it"),
+    "push_received_total": ("counter", "Commands pushed by the remote"),
+    "push_duplicates_total": ("counter", "Commands pushed by the remote again"),
+    "push_rejected_total": ("counter", "Pushed commands rejected as not authentic or outdated"),
+    "serial_lines_total": ("counter", "Status lines received on the serial port"),
+    "serial_garbled_total": ("counter", "Garbled lines received on the serial port"),
+    "serial_writes_total": ("counter", "Coalesced command writes to the serial port"),
+    "serial_writes_suppressed_total": ("counter", "Command updates not written as nothing changed"),
+    "serial_reopens_total": ("counter", "Serial port reopened by the link supervisor"),
+    "serial_resets_total": ("counter", "Reset pulses sent to the PIC by the link supervisor"),
+    "serial_recovery_seconds": ("histogram", "Time from the last status before a lost link to the first after"),
+    "serial_frames_total": ("counter", "Valid binary frames received on the serial port"),
+    "serial_frames_garbled_total": ("counter", "Binary frames with bad length or CRC"),
+    "serial_frames_lost_total": ("counter", "Binary frames lost according to the sequence numbers"),
+    "check_duration_seconds": ("histogram", "Execution time of the group check"),
+    "check_lag_seconds": ("histogram", "Delay of the group check behind its schedule"),
+    "udp_sent_total": ("counter", "Datagrams sent to the peer"),
+    "udp_received_total": ("counter", "Datagrams accepted from the peer"),
+    "udp_rejected_total": ("counter", "Datagrams rejected"),
+    "udp_lost_total": ("counter", "Datagrams lost according to the sequence numbers"),
+}
+
+prefix = "trafficlight_"
+
+
+class Histogram(object):
+    '''
+    Histogram with fixed bucket bounds.
+
+    Recording a value is one bisection and three additions,
+    so it can stay enabled in production. Buckets are
+    cumulated only when exported.
+    '''
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = tuple(buckets)
+        # The last one counts values above all bounds
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''
+        Returns (upper bound, number of values not above it)
+        for all buckets, the last bound being +Inf.
+        '''
+        result = []
+        total = 0
+        for (bound, count) in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if value is True or value is False:
+        return "1" if value else "0"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def label(name):
+    return name.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render(samples):
+    '''
+    Renders the Prometheus text format of samples, a dict
+    of light name -> dict as returned by TrafficLight.metrics().
+    '''
+    lines = []
+    for metric in sorted(descriptions):
+        (kind, text) = descriptions[metric]
+        found = [(light, values[metric]) for (light, values) in sorted(samples.items())
+                 if metric in values]
+        if not found:
+            continue
+        name = prefix + metric
+        lines.append("# HELP {} {}".format(name, text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for (light, value) in found:
+            labels = 'light="{}"'.format(label(light))
+            if kind != "histogram":
+                lines.append("{}{{{}}} {}".format(name, labels, format_value(value)))
+                continue
+            for (bound, count) in value.cumulative():
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, format_value(bound), count))
+            lines.append("{}_sum{{{}}} {}".format(name, labels, format_value(value.sum)))
+            lines.append("{}_count{{{}}} {}".format(name, labels, value.count))
+    return "\n".join(lines) + "\n"
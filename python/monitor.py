@@ -0,0 +1,201 @@
+import os
+import sys
+import heapq
+import threading
+from collections import Counter
+from time import time, sleep
+from twisted.internet import reactor, task
+from twisted.web import server
+from metrics import Histogram
+
+
+class Timing(object):
+    '''
+    Number, total and longest duration of the runs of
+    one callback.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def as_dict(self):
+        return {"count": self.count,
+                "total": self.total,
+                "mean": self.total / self.count if self.count else None,
+                "max": self.max,
+                }
+
+
+class Monitor(object):
+    '''
+    Watches the reactor for stalls.
+
+    Everything runs in one reactor thread, so a slow callback
+    delays all others, among them the group checks. The lag
+    of a timer firing every interval seconds shows how long
+    callbacks wait. Looping calls (see TimedLoopingCall) and
+    web renders (see TimedRequest) record their duration, the
+    keep slowest runs are kept as worst offenders.
+    '''
+
+    def __init__(self, interval=.1, keep=20):
+        self.interval = interval
+        self.keep = keep
+        self.lag = Histogram()
+        self.lag_max = 0.
+        self.timings = {}
+        # Heap of (duration, time, name, detail)
+        self.offenders = []
+        self.timer = None
+        self.started = time()
+
+    def start(self, interval=None, keep=None):
+        if interval is not None:
+            self.interval = interval
+        if keep is not None:
+            self.keep = keep
+        if self.timer is None:
+            self.timer = reactor.callLater(self.interval, self.tick, time() + self.interval)
+
+    def stop(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+    def tick(self, due):
+        now = time()
+        lag = max(0., now - due)
+        self.lag.observe(lag)
+        if lag > self.lag_max:
+            self.lag_max = lag
+        self.timer = reactor.callLater(self.interval, self.tick, now + self.interval)
+
+    def record(self, name, duration, detail=None):
+        '''
+        Records the duration of a callback. Costs a dict lookup
+        and, for the slow ones, a heap operation.
+        '''
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = Timing()
+        timing.add(duration)
+        if len(self.offenders) < self.keep:
+            heapq.heappush(self.offenders, (duration, time(), name, detail))
+        elif duration > self.offenders[0][0]:
+            heapq.heapreplace(self.offenders, (duration, time(), name, detail))
+
+    def report(self):
+        '''
+        Returns the lag statistics, timings and worst offenders,
+        slowest first, as dict suitable for JSON encoding.
+        '''
+        return {"uptime": time() - self.started,
+                "interval": self.interval,
+                "lag": {"count": self.lag.count,
+                        "mean": self.lag.sum / self.lag.count if self.lag.count else None,
+                        "max": self.lag_max,
+                        "buckets": [(bound if bound != float("inf") else None, count)
+                                    for (bound, count) in self.lag.cumulative()],
+                        },
+                "timings": {name: timing.as_dict() for (name, timing) in self.timings.items()},
+                "offenders": [{"duration": duration, "time": when, "name": name, "detail": detail}
+                              for (duration, when, name, detail) in sorted(self.offenders, reverse=True)],
+                }
+
+
+# The monitor of this process
+monitor = Monitor()
+
+
+class TimedLoopingCall(task.LoopingCall):
+    '''
+    LoopingCall recording the duration of every run in
+    the monitor.
+    '''
+
+    def __call__(self):
+        started = time()
+        try:
+            task.LoopingCall.__call__(self)
+        finally:
+            name = getattr(self.f, "__qualname__", repr(self.f))
+            # Tells apart instances by the name of their logger
+            owner = getattr(getattr(self.f, "__self__", None), "logger", None)
+            monitor.record(name, time() - started, getattr(owner, "name", None))
+
+
+class TimedRequest(server.Request):
+    '''
+    Request recording the duration of rendering in the
+    monitor. Only the synchronous part is measured, held
+    requests are not blocking the reactor while waiting.
+    '''
+
+    def render(self, resrc):
+        started = time()
+        try:
+            server.Request.render(self, resrc)
+        finally:
+            monitor.record("render " + type(resrc).__name__, time() - started,
+                           self.uri.decode('ascii', 'replace'))
+
+
+class Profiler(object):
+    '''
+    Sampling profiler for a thread, by default the reactor's.
+
+    A helper thread looks at the stack of the profiled thread
+    every interval seconds. Stacks are counted in collapsed
+    form ("outer;...;inner count"), which flame graph tools
+    read directly.
+    '''
+    lock = threading.Lock()
+
+    def __init__(self, thread_id=None, interval=.005):
+        if thread_id is None:
+            thread_id = threading.get_ident()
+        self.thread_id = thread_id
+        self.interval = interval
+
+    def run(self, seconds):
+        '''
+        Samples for seconds and returns a Counter of collapsed
+        stacks. Blocks, so run it outside of the profiled thread.
+        Only one profile runs at a time, returns None if another
+        one is running.
+        '''
+        if not self.lock.acquire(False):
+            return None
+        try:
+            stacks = Counter()
+            end = time() + seconds
+            while time() < end:
+                frame = sys._current_frames().get(self.thread_id)
+                if frame is not None:
+                    stacks[self.collapse(frame)] += 1
+                del frame
+                sleep(self.interval)
+            return stacks
+        finally:
+            self.lock.release()
+
+    def collapse(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    @staticmethod
+    def format(stacks):
+        return "".join("{} {}\n".format(stack, count) for (stack, count) in stacks.most_common())
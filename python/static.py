@@ -0,0 +1,207 @@
+'''
+Serves the web UI from memory, compressed and cacheable.
+
+Writes gzip (and brotli, if installed) variants next to the
+files ahead of time, e.g.
+
+    python3 static.py ../website
+'''
+import os
+import re
+import sys
+import gzip
+import hashlib
+import logging
+import argparse
+import mimetypes
+from twisted.web import resource, http
+
+try:
+    import brotli
+except ImportError:
+    # Only gzip variants are built then
+    brotli = None
+
+mimetypes.add_type("image/svg+xml", ".svg")
+mimetypes.add_type("application/javascript", ".js")
+
+compressible = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+# References to other assets in HTML files, rewritten to versioned URLs
+reference = re.compile(r'''((?:src|href)=["'])([^"':?#]+)(["'])''')
+
+# Answers to versioned URLs never change
+immutable = b"public, max-age=31536000, immutable"
+
+
+def is_compressible(content_type):
+    return any(content_type.startswith(x) for x in compressible)
+
+
+def compress(data):
+    '''
+    Returns the compressed variants of data by encoding.
+    '''
+    variants = {"gzip": gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data)
+    return variants
+
+
+class Asset(resource.Resource):
+    '''
+    One file with its compressed variants, all kept in memory
+    unless the file is larger than max_size. The ETag is a hash
+    of the content, its first 8 characters are the version used
+    in URLs.
+    '''
+    isLeaf = True
+
+    def __init__(self, path, data, max_size):
+        resource.Resource.__init__(self)
+        self.path = path
+        self.size = len(data)
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.hash = hashlib.sha256(data).hexdigest()[:16]
+        self.version = self.hash[:8]
+        # Encoding -> content, only if smaller than the file
+        self.variants = {}
+        if is_compressible(self.content_type):
+            for (encoding, content) in self.precompressed(path, data).items():
+                if len(content) < self.size:
+                    self.variants[encoding] = content
+        self.data = data if self.size <= max_size else None
+
+    def precompressed(self, path, data):
+        '''
+        Variants found next to the file (see __main__), built
+        now if missing or outdated.
+        '''
+        variants = {}
+        for (encoding, suffix) in (("gzip", ".gz"), ("br", ".br")):
+            name = path + suffix
+            if os.path.exists(name) and os.path.getmtime(name) >= os.path.getmtime(path):
+                with open(name, "rb") as f:
+                    variants[encoding] = f.read()
+        if "gzip" not in variants or ("br" not in variants and brotli is not None):
+            built = compress(data)
+            built.update(variants)
+            variants = built
+        return variants
+
+    def content(self):
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def encoding(self, request):
+        accepted = request.getHeader(b"accept-encoding") or b""
+        accepted = [x.split(b";")[0].strip() for x in accepted.split(b",")]
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding.encode('ascii') in accepted:
+                return encoding
+        return None
+
+    def render_GET(self, request):
+        encoding = self.encoding(request)
+        request.setHeader(b"content-type", self.content_type.encode('ascii'))
+        if self.variants:
+            request.setHeader(b"vary", b"accept-encoding")
+        if request.args.get(b"v", [b""])[0] == self.version.encode('ascii'):
+            request.setHeader(b"cache-control", immutable)
+        else:
+            request.setHeader(b"cache-control", b"no-cache")
+        etag = self.hash if encoding is None else "{}-{}".format(self.hash, encoding)
+        if request.setETag('"{}"'.format(etag).encode('ascii')) == http.CACHED:
+            return b""
+        if encoding is None:
+            return self.content()
+        request.setHeader(b"content-encoding", encoding.encode('ascii'))
+        return self.variants[encoding]
+
+
+class StaticAssets(resource.Resource):
+    '''
+    All files below directory, read once at startup. Requests
+    for the directory get index. Local references in HTML files
+    get the version of their target appended ("?v=..."), so
+    browsers cache those for a year and only revalidate the
+    page itself.
+    '''
+
+    def __init__(self, directory, index="index.html", max_size=512 * 1024):
+        resource.Resource.__init__(self)
+        self.directory = directory
+        self.index = index
+        self.max_size = max_size
+        # Path relative to directory -> Asset
+        self.assets = {}
+        self.scan()
+
+    def scan(self):
+        html = []
+        for (base, dirs, files) in os.walk(self.directory):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(base, name)
+                relative = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                if name.endswith((".gz", ".br")) and os.path.exists(path[:-3]):
+                    continue
+                if name.endswith(".html"):
+                    html.append((path, relative))
+                    continue
+                with open(path, "rb") as f:
+                    self.assets[relative] = Asset(path, f.read(), self.max_size)
+        # Pages last, they refer to the versions of the others
+        for (path, relative) in html:
+            with open(path, "rb") as f:
+                data = self.versioned(relative, f.read().decode('utf8'))
+            self.assets[relative] = Asset(path, data.encode('utf8'), self.max_size)
+        total = sum(x.size for x in self.assets.values())
+        compressed = sum(min([x.size] + [len(v) for v in x.variants.values()])
+                         for x in self.assets.values())
+        logging.info("Static assets: {} files, {} bytes, {} compressed".format(
+                     len(self.assets), total, compressed))
+
+    def versioned(self, page, text):
+        directory = os.path.dirname(page)
+
+        def replace(match):
+            target = os.path.normpath(os.path.join(directory, match.group(2))).replace(os.sep, "/")
+            if target not in self.assets:
+                return match.group(0)
+            return "{}{}?v={}{}".format(match.group(1), match.group(2),
+                                        self.assets[target].version, match.group(3))
+        return reference.sub(replace, text)
+
+    def getChild(self, name, request):
+        path = [name] + request.postpath
+        if path[-1] == b"":
+            path[-1] = self.index.encode('utf8')
+        relative = "/".join(x.decode('utf8', 'replace') for x in path)
+        asset = self.assets.get(relative)
+        if asset is None:
+            return resource.NoResource()
+        return asset
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory", help="directory of the web UI")
+    args = parser.parse_args()
+    if brotli is None:
+        print("brotli not installed, only writing gzip variants", file=sys.stderr)
+    for (base, dirs, files) in os.walk(args.directory):
+        for name in files:
+            path = os.path.join(base, name)
+            if name.endswith((".gz", ".br")) or name.endswith(".html"):
+                continue
+            if not is_compressible(mimetypes.guess_type(path)[0] or ""):
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            for (encoding, content) in compress(data).items():
+                if len(content) < len(data):
+                    with open(path + (".gz" if encoding == "gzip" else ".br"), "wb") as f:
+                        f.write(content)
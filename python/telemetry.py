@@ -0,0 +1,167 @@
+from array import array
+from time import time
+
+
+class Level(object):
+    '''
+    Ring of samples or buckets in compact arrays.
+
+    Every entry has a time, a state and min/max/mean of
+    each channel (battery voltage and lamp currents).
+    Raw samples have min == max == mean.
+    '''
+
+    def __init__(self, resolution, size, channels):
+        self.resolution = resolution
+        self.size = size
+        self.channels = channels
+        self.count = 0
+        self.next = 0
+        self.time = array('d', [0.]) * size
+        self.state = array('B', [0]) * size
+        self.min = [array('f', [0.]) * size for x in range(channels)]
+        self.max = [array('f', [0.]) * size for x in range(channels)]
+        self.mean = [array('f', [0.]) * size for x in range(channels)]
+        # Bucket currently being filled
+        self.start = None
+        self.samples = 0
+        self.last_state = 0
+        self.sums = [0.] * channels
+        self.mins = [0.] * channels
+        self.maxs = [0.] * channels
+
+    def store(self, t, state, mins, maxs, means):
+        i = self.next
+        self.time[i] = t
+        self.state[i] = state
+        for c in range(self.channels):
+            self.min[c][i] = mins[c]
+            self.max[c][i] = maxs[c]
+            self.mean[c][i] = means[c]
+        self.next = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def add(self, t, state, values):
+        '''
+        Adds a sample, raw levels store it right away, others
+        fold it into the current bucket.
+        '''
+        if self.resolution == 0:
+            self.store(t, state, values, values, values)
+            return
+        start = t - t % self.resolution
+        if self.start is not None and start != self.start:
+            self.flush()
+        if self.samples == 0:
+            self.start = start
+            self.mins = list(values)
+            self.maxs = list(values)
+            self.sums = list(values)
+        else:
+            for c in range(self.channels):
+                v = values[c]
+                if v < self.mins[c]:
+                    self.mins[c] = v
+                if v > self.maxs[c]:
+                    self.maxs[c] = v
+                self.sums[c] += v
+        self.samples += 1
+        self.last_state = state
+
+    def flush(self):
+        if self.samples:
+            means = [x / self.samples for x in self.sums]
+            self.store(self.start, self.last_state, self.mins, self.maxs, means)
+        self.samples = 0
+
+    def oldest(self):
+        if self.count == 0:
+            return None
+        return self.time[(self.next - self.count) % self.size]
+
+    def indexes(self, since):
+        '''
+        Ring positions of all entries not older than since,
+        oldest first.
+        '''
+        first = self.next - self.count
+        return [i % self.size for i in range(first, self.next)
+                if self.time[i % self.size] >= since]
+
+
+class TelemetryRing(object):
+    '''
+    History of a traffic light with fixed memory usage.
+
+    Samples are recorded whenever the light publishes a
+    change (use record as subscriber). They are kept raw in
+    the first level and folded into min/max/mean buckets of
+    coarser levels, each level being a ring of fixed size.
+    The defaults keep an hour of raw samples, a day of 10 s,
+    a week of 1 min and two months of 10 min buckets in
+    about 2 MB.
+    '''
+    # (resolution in seconds, number of entries)
+    levels = ((0, 3600), (10, 8640), (60, 10080), (600, 8640))
+
+    def __init__(self, levels=None):
+        if levels is not None:
+            self.levels = levels
+        # Battery voltage and three lamp currents
+        self.channels = 4
+        self.rings = [Level(resolution, size, self.channels)
+                      for (resolution, size) in self.levels]
+
+    def record(self, light):
+        try:
+            state = min(max(int(light.state), 0), 255)
+            values = [float(light.batt_voltage)] + [float(x) for x in light.lamp_currents[:3]]
+        except (ValueError, TypeError):
+            return
+        self.add(time(), state, values)
+
+    def add(self, t, state, values):
+        for ring in self.rings:
+            ring.add(t, state, values)
+
+    def select(self, since, resolution):
+        '''
+        Finest level with at least the wanted resolution
+        which still reaches back to since.
+        '''
+        candidates = [ring for ring in self.rings if ring.resolution >= resolution]
+        if not candidates:
+            candidates = self.rings[-1:]
+        for ring in candidates:
+            oldest = ring.oldest()
+            if oldest is not None and oldest <= since:
+                return ring
+        # None does, take the one reaching back furthest
+        filled = [ring for ring in candidates if ring.count]
+        if not filled:
+            return candidates[0]
+        return min(filled, key=lambda ring: ring.oldest() + ring.resolution)
+
+    def history(self, since=0, resolution=0):
+        '''
+        Returns the history since the given time as dict of
+        columns, suitable for JSON encoding.
+        '''
+        ring = self.select(since, resolution)
+        indexes = ring.indexes(since)
+
+        def column(values):
+            return [round(values[i], 3) for i in indexes]
+
+        def channel(c):
+            return {"min": column(ring.min[c]),
+                    "max": column(ring.max[c]),
+                    "mean": column(ring.mean[c]),
+                    }
+
+        return {"resolution": ring.resolution,
+                "time": [ring.time[i] for i in indexes],
+                "state": [ring.state[i] for i in indexes],
+                "batt_voltage": channel(0),
+                "lamp_currents": [channel(c) for c in range(1, self.channels)],
+                }
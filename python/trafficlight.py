@@ -3,13 +3,44 @@ import logging
 import random
 import urllib.request, urllib.parse, urllib.error
 import os
+import itertools
+from io import BytesIO
+from hmac import compare_digest
+from array import array
+from collections import deque
 from twisted.internet.serialport import SerialPort
-from twisted.internet import reactor, task
-from twisted.web.client import Agent, readBody
+from twisted.internet import reactor, defer, protocol
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseNeverReceived, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
 from twisted.protocols import basic
 from twisted.python import log
 from time import time
-from auth import TransportWrapper
+from auth import TransportWrapper, DatagramWrapper
+from hotplug import ControllerDiscovery
+from metrics import Histogram
+from monitor import TimedLoopingCall
+import journal
+import framing
+
+try:
+    import numpy
+except ImportError:
+    # The fleet simulation falls back to plain Python
+    numpy = None
+
+
+def restart_loop(loop, interval, now=True):
+    '''
+    Restarts a looping call with a new interval.
+    '''
+    if loop.running:
+        loop.stop()
+    loop.start(interval, now).addErrback(log.err)
+
+
+def stop_loop(loop):
+    if loop is not None and loop.running:
+        loop.stop()
 
 
 class TrafficLight(object):
@@ -18,6 +49,17 @@ class TrafficLight(object):
     This provides a skeleton for creating either physical
     interfaces or virtual traffic lights.
     '''
+    # Distinguishes state versions of this process from those
+    # of an earlier run.
+    instance = "{:x}".format(int(time() * 1000))
+    # Sealed snapshots are re-signed after this many seconds,
+    # so their time stays within the clients' window.
+    reseal_interval = 1
+    # Whether a history (see telemetry.TelemetryRing) is kept
+    keep_history = True
+    # True for lights representing another unit, their state
+    # can only be read
+    peer = False
 
     def __init__(self):
         self.logger = logging.getLogger()
@@ -32,6 +74,13 @@ class TrafficLight(object):
         self.web_writeable = False
         self.group_key = None
         self.transportWrapper = None
+        self.subscribers = []
+        self.published = None
+        self.version = 0
+        self.snapshot = None
+        self.sealed = {}
+        self.last_sealed = None
+        self.journal = None
 
     def setGroupKey(self, key):
         '''
@@ -47,22 +96,60 @@ class TrafficLight(object):
         '''
         if self.web_writeable:
             return True
-        if self.group_key is None:
+        if self.group_key is None or key is None:
             return False
-        if self.group_key == key:
-            return True
-        return False
+        return compare_digest(self.group_key.encode('utf8'), key.encode('utf8'))
 
     def dereference(self, names):
         '''
         Dereferece symbolic names (if needed) after reading
-        of config has been finished.
+        of config has been finished. Runs again on a reload
+        if one of the references was replaced.
+        '''
+        pass
+
+    def references(self):
+        '''
+        Names of the lights this one dereferences.
+        '''
+        return []
+
+    def retune(self, options):
+        '''
+        Applies changed config options (strings, as passed to
+        open) on a reload. Returns the names of those which
+        cannot be changed at runtime, the light is rebuilt then.
+        '''
+        return set(options)
+
+    def stop(self):
+        '''
+        Stops loops and connections of a light removed or
+        rebuilt on a reload. May return a Deferred firing once
+        its ports are released.
         '''
         pass
 
     def setLogger(self, logger):
         self.logger = logger
 
+    def members(self):
+        '''
+        Further lights created by this one, as dict by name
+        (see TrafficLightFleet).
+        '''
+        return {}
+
+    def setJournal(self, journal):
+        self.journal = journal
+
+    def journalEvent(self, kind, value):
+        '''
+        Records a decision in the journal, if there is one.
+        '''
+        if self.journal is not None:
+            self.journal.event(self, kind, value)
+
     def setReadOnly(self, read_only):
         self.read_only = read_only
 
@@ -73,14 +160,97 @@ class TrafficLight(object):
         '''
         return (time()-self.last_seen) < self.maxage
 
-    def to_json(self, challenge):
+    def freshness(self):
         '''
-        Returns the state of a traffic light in JSON
-        format.
-        If challenge is passed, the data packet it will be
-        encapsulated in a TransportWrapper.
+        Age of the last report and the estimates seen() is
+        based on.
+        '''
+        return {"age": time() - self.last_seen,
+                "maxage": self.maxage,
+                }
+
+    def subscribe(self, callback):
+        '''
+        Registers a callback which is called with this traffic
+        light as argument whenever its published state changes.
+        '''
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def publishState(self):
+        '''
+        Compares the current state with the last published one.
+        If anything has changed, the version is increased, the
+        JSON snapshot is rebuilt and all subscribers are notified.
+        Implementations call this after updating their fields.
+        Returns True if a change was published.
+        '''
+        data = self.status()
+        current = (data["state"], data["batt_voltage"], tuple(data["lamp_currents"]),
+                   data["good"], data["give_way"], data["temp_error"])
+        if current == self.published:
+            return False
+        self.published = current
+        self.version += 1
+        self.snapshot = bytes(json.dumps(data).encode('utf8'))
+        for callback in list(self.subscribers):
+            try:
+                callback(self)
+            except Exception:
+                log.err()
+        return True
+
+    def getSnapshot(self):
         '''
-        data = {
+        Returns a tuple of the state version and the pre-encoded
+        JSON representation of the state.
+        '''
+        # Liveness depends on time, so it has to be re-evaluated.
+        self.publishState()
+        return (self.version, self.snapshot)
+
+    def statistics(self):
+        '''
+        Returns runtime statistics of this traffic light as dict.
+        '''
+        return {"version": self.version,
+                "age": time() - self.last_seen,
+                }
+
+    def metrics(self):
+        '''
+        Returns runtime metrics of this traffic light as dict,
+        see metrics.descriptions for the names.
+        '''
+        # Liveness as last published, isGood may have side effects
+        return {"state_version": self.version,
+                "age_seconds": time() - self.last_seen,
+                "good": self.published is not None and self.published[3] is True,
+                }
+
+    def getSealedSnapshot(self, envelope="json"):
+        '''
+        Returns the state signed without challenge (see
+        TransportWrapper.seal). It is only re-signed when the
+        state changed or the signature gets old, so one
+        signature serves all clients.
+        '''
+        version = self.getSnapshot()[0]
+        cached = self.sealed.get(envelope)
+        if cached is None or cached[0] != version or time() - cached[1] > self.reseal_interval:
+            sealed = self.transportWrapper.seal(self.status(), version, self.instance, envelope)
+            cached = (version, time(), bytes(sealed.encode('utf8')))
+            self.sealed[envelope] = cached
+        return cached[2]
+
+    def status(self):
+        '''
+        Returns the state of a traffic light as dict.
+        '''
+        return {
             "state":self.state,
             "batt_voltage":self.batt_voltage,
             "lamp_currents":self.lamp_currents,
@@ -88,36 +258,64 @@ class TrafficLight(object):
             "give_way":self.give_way,
             "temp_error":self.temp_error
             }
+
+    def to_json(self, challenge, envelope="json"):
+        '''
+        Returns the state of a traffic light in JSON
+        format.
+        If challenge is passed, the data packet it will be
+        encapsulated in a TransportWrapper, using the given
+        envelope format.
+        '''
         if challenge is not None and self.transportWrapper is None:
             self.logger.error("missing transport wrapper")
         if challenge is not None and self.transportWrapper is not None:
-            return bytes(self.transportWrapper.encapsulate(challenge, data).encode('utf8'))
+            data = self.status()
+            return bytes(self.transportWrapper.encapsulate(challenge, data, envelope).encode('utf8'))
         else:
-            return bytes(json.dumps(data).encode('utf8'))
+            return self.getSnapshot()[1]
 
-    def from_json(self, raw, challenge=None):
+    def from_json(self, raw, challenge=None, window=None):
         '''
         Recovers data from a JSON representation.
-        This has two operational modes:
+        This has three operational modes:
         
         If challenge is None it simply reads in the JSON
         data and sets internal state accordingly.
 
         When a challenge is passed, it uses the transportWrapper
         subsystem to ensure authenticty of message.
+
+        When a window is passed, the message has to be sealed
+        within window seconds and must not be older than the
+        last one accepted.
         '''
-        if challenge is None:
+        if window is not None:
+            data = self.transportWrapper.unseal(raw, window, self.last_sealed)
+            if data:
+                self.last_sealed = data
+        elif challenge is None:
             data = json.loads(raw)
         else:
             data = self.transportWrapper.decapsulate(raw, challenge)
         self.logger.debug("data={}".format(data))
-        if data is None:
+        if not data:
             self.logger.error("Transport failed")
+            raise ValueError("Transport failed")
         (self.state, self.batt_voltage, self.lamp_currents) = (data["state"],
                                                                data["batt_voltage"],
                                                                data["lamp_currents"]
                                                                )
         (self.give_way, self.temp_error) = (data["give_way"], data["temp_error"])
+        self.publishState()
+        return data
+
+    def pushed(self, raw):
+        '''
+        Applies a command pushed by the peer this light
+        represents (see CommandPush), returns the acknowledgement.
+        '''
+        raise ValueError("Only remote lights accept pushed commands")
 
     def setConfig(self, param, value):
         # Dummy to be overloaded by real implementations
@@ -134,6 +332,7 @@ class TrafficLight(object):
 
             self.give_way = give_way
             self.sendUpdate()
+            self.publishState()
 
     def isGood(self):
         return (self.state != 9) and (self.seen())
@@ -148,6 +347,7 @@ class TrafficLight(object):
                 self.logger.debug("No temp error")
             self.temp_error = error_state
             self.sendUpdate()
+            self.publishState()
 
     def __str__(self):
         return "TrafficLight(state={}, batt_voltage={}, lamp_currents={})".format(self.state, self.batt_voltage, self.lamp_currents)
@@ -159,14 +359,73 @@ class TrafficLight(object):
         pass
 
 
+class OutputScheduler(object):
+    '''
+    Coalesced, change-only output of command lines to a
+    LineReceiver.
+
+    Lines are set by key (e.g. "green" -> b"G"), setting them
+    schedules one write at the end of the current reactor turn.
+    It contains only lines which changed since the last write,
+    unless keepalive seconds have passed since, then all lines
+    are refreshed. refresh() is to be called regularly for that
+    if nothing else sets lines.
+    '''
+
+    def __init__(self, receiver, keepalive=1):
+        self.receiver = receiver
+        self.keepalive = keepalive
+        self.wanted = {}
+        self.sent = {}
+        self.last_write = 0
+        self.pending = None
+        self.writes = 0
+        self.suppressed = 0
+
+    def set(self, key, line):
+        self.wanted[key] = line
+        if self.pending is None or not self.pending.active():
+            self.pending = reactor.callLater(0, self.flush)
+
+    def refresh(self):
+        if time() - self.last_write >= self.keepalive:
+            self.flush()
+
+    def flush(self):
+        self.pending = None
+        if time() - self.last_write >= self.keepalive:
+            lines = list(self.wanted.values())
+        else:
+            lines = [line for (key, line) in self.wanted.items() if self.sent.get(key) != line]
+        if not lines:
+            self.suppressed += 1
+            return
+        transport = self.receiver.transport
+        if transport is None:
+            return
+        delimiter = self.receiver.delimiter
+        transport.write(b"".join(line + delimiter for line in lines))
+        self.sent.update(self.wanted)
+        self.last_write = time()
+        self.writes += 1
+
+
 class TrafficLightController(basic.LineReceiver):
+    '''
+    Handheld controller of a master group. The status line
+    is only sent when it changed, and at least every keepalive
+    seconds.
+    '''
+
     @classmethod
-    def open(cls, port, group):
+    def open(cls, port, group, keepalive=1):
         controller = cls()
+        controller.output = OutputScheduler(controller, keepalive)
         serial = SerialPort(baudrate=19200, deviceNameOrPortNumber=port,
                             protocol=controller, reactor=reactor)
         controller.setSerial(serial)
         controller.setGroup(group)
+        controller.port = port
         return controller
 
     def connectionLost(self, reason):
@@ -187,10 +446,12 @@ class TrafficLightController(basic.LineReceiver):
                 self.group.give_way = False
                 self.group.temp_error = False
                 self.group.sendUpdate()
+                self.group.scheduleCheck()
             elif c == "G":
                 self.group.give_way = True
                 self.group.temp_error = False
                 self.group.sendUpdate()
+                self.group.scheduleCheck()
             # TODO: Should we really discard siently?
 
     def sendUpdate(self):
@@ -202,10 +463,87 @@ class TrafficLightController(basic.LineReceiver):
         # FIXME: Classify Battery local/remote in good/bad
         packet += [str(self.group.state), str(self.group.batt_voltage)]
         cmd = " ".join(packet)
-        self.sendLine(bytes(cmd.encode("ascii")))
+        self.output.set("status", cmd.encode("ascii"))
+
+
+class CheckedLight(TrafficLight):
+    '''
+    Base for lights deciding on the state of other lights
+    in check. It runs every check_interval seconds and at the
+    end of each reactor turn scheduleCheck was called in.
+    '''
+
+    def __init__(self, check_interval=1):
+        TrafficLight.__init__(self)
+        self.dereferenced = False
+        self.pending_check = None
+        self.check_duration = Histogram()
+        self.check_lag = Histogram()
+        self.check_loop = TimedLoopingCall(self.timedCheck)
+        self.check_loop.start(check_interval, now=False).addErrback(log.err)
+
+    def check(self):
+        pass
+
+    def retune(self, options):
+        if "check_interval" in options:
+            restart_loop(self.check_loop, float(options["check_interval"]), now=False)
+        return set(options) - {"check_interval"}
+
+    def stop(self):
+        stop_loop(self.check_loop)
+        if self.pending_check is not None and self.pending_check.active():
+            self.pending_check.cancel()
+
+    def scheduleCheck(self):
+        '''
+        Runs check at the end of the current reactor turn,
+        so several changes in one turn only cause one check.
+        '''
+        if self.pending_check is None or not self.pending_check.active():
+            self.pending_check = reactor.callLater(0, self.timedCheck, time())
 
+    def timedCheck(self, due=None):
+        '''
+        Runs check, recording how late it runs and how long
+        it takes.
+        '''
+        started = time()
+        if due is None:
+            # Run by check_loop, which is due on a grid of
+            # check_interval seconds (lag is modulo the interval).
+            due = started - (started - self.check_loop.starttime) % self.check_loop.interval
+        self.check_lag.observe(started - due)
+        try:
+            return self.check()
+        finally:
+            self.check_duration.observe(time() - started)
 
-class TrafficLightGroup(TrafficLight):
+    def metrics(self):
+        result = TrafficLight.metrics(self)
+        result["check_duration_seconds"] = self.check_duration
+        result["check_lag_seconds"] = self.check_lag
+        return result
+
+
+class TrafficLightGroup(CheckedLight):
+    '''
+    Couples a local and a remote traffic light.
+
+    The group checks its members whenever one of them
+    publishes a change. The check_loop running every
+    check_interval seconds only catches members going stale.
+
+    A master attaches a handheld controller as soon as one
+    of the controllers paths (space separated, wildcards
+    allowed) appears, optionally restricted to USB devices
+    with id controller_id ("VENDOR:PRODUCT"). Its status line
+    is refreshed every controller_keepalive seconds.
+
+    A master given the URL of the light representing it on the
+    slave as push sends its commands there as soon as they
+    change (see CommandPush).
+    '''
     # Names of all controller files to be scanned
     controller_devs = ["{}{}".format(prefix, i)
                         for i in range(5)
@@ -214,73 +552,169 @@ class TrafficLightGroup(TrafficLight):
 
     @classmethod
     def open(cls, name, i_am_master, local, remote, max_diverge=10,
-             group_key=None):
+             group_key=None, check_interval=1, controllers=None,
+             controller_id=None, controller_keepalive=1, push=None,
+             push_timeout=1, push_retries=5):
         if str(i_am_master).upper() in ("YES", "TRUE", "1"):
             i_am_master = True
         else:
             i_am_master = False
-        r = cls(i_am_master, local, remote, group_key, max_diverge)
+        if controllers is not None:
+            controllers = controllers.split()
+        if push is not None and not i_am_master:
+            raise ValueError("Only a master pushes commands")
+        r = cls(i_am_master, local, remote, group_key, float(max_diverge),
+                float(check_interval), controllers, controller_id,
+                float(controller_keepalive), push, float(push_timeout),
+                int(push_retries))
         r.setLogger(logging.getLogger(name))
         return r
 
-    def __init__(self, i_am_master, local, remote, group_key, max_diverge=5):
-        TrafficLight.__init__(self)
+    def __init__(self, i_am_master, local, remote, group_key, max_diverge=5,
+                 check_interval=1, controllers=None, controller_id=None,
+                 controller_keepalive=1, push=None, push_timeout=1, push_retries=5):
+        CheckedLight.__init__(self, check_interval)
+        self.pusher = None
+        if push is not None:
+            self.pusher = CommandPush(push, push_timeout, push_retries)
+        # Command last pushed
+        self.pushed = None
         self.i_am_master = i_am_master
         self.remote = remote
         self.local = local
+        self.remote_name = remote
+        self.local_name = local
         self.max_diverge = max_diverge
         self.start_diverge = None
-        self.dereferenced = False
         self.setGroupKey(group_key)
-        self.check_loop = task.LoopingCall(self.check)
-        self.check_loop.start(.25).addErrback(log.err)
         self.controller = None
+        if controllers is not None:
+            self.controller_devs = controllers
+        self.controller_id = controller_id
+        self.controller_keepalive = controller_keepalive
+        self.discovery = None
+        self.journaled = (self.give_way, self.temp_error)
+
+    def setGroupKey(self, key):
+        CheckedLight.setGroupKey(self, key)
+        if self.pusher is not None:
+            self.pusher.setGroupKey(key)
+
+    def setLogger(self, logger):
+        CheckedLight.setLogger(self, logger)
+        if self.pusher is not None:
+            self.pusher.logger = logger
 
     def controllerLost(self):
         '''
         Signals that the controller instance is now
         invalid.
         '''
+        self.logger.info("Controller lost")
         self.controller = None
+        self.journalEvent(journal.CONTROLLER_DETACH, 0)
+        if self.discovery is not None:
+            # Another controller may be plugged in already
+            reactor.callLater(1, self.discovery.scan)
 
     def dereference(self, names):
         '''
         Dereferece symbolic names (if needed)
         '''
-        if self.local in names:
-            self.local = names[self.local]
-        else:
-            raise ValueError("Cannot find name {} for local.".format(self.local))
-
-        if self.remote in names:
-            self.remote = names[self.remote]
-        else:
-            raise ValueError("Cannot find name {} for remote.".format(self.remote))
+        if self.local_name not in names:
+            raise ValueError("Cannot find name {} for local.".format(self.local_name))
+        if self.remote_name not in names:
+            raise ValueError("Cannot find name {} for remote.".format(self.remote_name))
+        if self.dereferenced:
+            self.local.unsubscribe(self.on_member_changed)
+            self.remote.unsubscribe(self.on_member_changed)
+        self.local = names[self.local_name]
+        self.remote = names[self.remote_name]
         self.remote.setReadOnly(not self.i_am_master)
         self.remote.setGroupKey(self.group_key)
         self.local.setGroupKey(self.group_key)
         self.web_writeable = self.i_am_master
         self.dereferenced = True
+        self.local.subscribe(self.on_member_changed)
+        self.remote.subscribe(self.on_member_changed)
+        if self.i_am_master and self.discovery is None:
+            self.discovery = ControllerDiscovery(self, self.controller_devs,
+                                                 self.controller_id,
+                                                 claimed=TrafficLightSerial.ports)
+            self.discovery.start()
+
+    def references(self):
+        return [self.local_name, self.remote_name]
+
+    def retune(self, options):
+        rest = CheckedLight.retune(self, options)
+        if "max_diverge" in rest:
+            self.max_diverge = float(options["max_diverge"])
+        if "group_key" in rest:
+            # Passed on to the members when dereferenced again
+            self.setGroupKey(options["group_key"])
+        if "controller_keepalive" in rest:
+            self.controller_keepalive = float(options["controller_keepalive"])
+            if self.controller is not None:
+                self.controller.output.keepalive = self.controller_keepalive
+        return rest - {"max_diverge", "group_key", "controller_keepalive"}
+
+    def stop(self):
+        CheckedLight.stop(self)
+        if self.dereferenced:
+            self.local.unsubscribe(self.on_member_changed)
+            self.remote.unsubscribe(self.on_member_changed)
+        if self.discovery is not None:
+            self.discovery.stop()
+            self.discovery = None
+        if self.controller is not None:
+            self.controller.transport.loseConnection()
+        if self.pusher is not None:
+            self.pusher.stop()
+
+    def on_member_changed(self, light):
+        if light is self.local and self.pusher is not None:
+            command = (bool(light.give_way), bool(light.temp_error))
+            if command != self.pushed:
+                self.pushed = command
+                # After the output to the local light went out
+                reactor.callLater(0, self.pusher.push, light.version, *command)
+        self.scheduleCheck()
+
+    def metrics(self):
+        result = CheckedLight.metrics(self)
+        if self.pusher is not None:
+            result.update(self.pusher.metrics())
+        if self.dereferenced:
+            # The group is as old as its oldest member
+            result["age_seconds"] = time() - min(self.local.last_seen, self.remote.last_seen)
+        return result
 
     def seen(self):
         return self.local.seen() and self.remote.seen()
 
-    def probe_controller(self):
+    def statistics(self):
+        stats = CheckedLight.statistics(self)
+        if self.dereferenced:
+            # What the liveness of the members is based on
+            stats["local"] = self.local.freshness()
+            stats["remote"] = self.remote.freshness()
+        if self.pusher is not None:
+            stats["push"] = self.pusher.statistics()
+        return stats
+
+    def attachController(self, path):
         """
-        Tries to find a controller by rotating the
-        list of known file names and trying to access them
+        Opens path as handheld controller, called by the
+        controller discovery.
         """
-        # Process a whole list of options
-        for path in self.controller_devs:
-            self.logger.debug("Try '{}'".format(path))
-            if os.path.exists(path):
-                self.logger.debug("'{}' exists".format(path))
-                try:
-                    self.controller = TrafficLightController.open(path, self)
-
-                except Exception as e:
-                    self.logger.error("Opening path {} as a controller failed: {}"
-                                      .format(path, e))
+        try:
+            self.controller = TrafficLightController.open(path, self, self.controller_keepalive)
+            self.logger.info("Controller attached at '{}'".format(path))
+            self.journalEvent(journal.CONTROLLER_ATTACH, 1)
+        except Exception as e:
+            self.logger.error("Opening path {} as a controller failed: {}"
+                              .format(path, e))
 
     def check(self):
         """
@@ -293,11 +727,6 @@ class TrafficLightGroup(TrafficLight):
             logging.debug("Cannot check yet, not dereferenced yet")
             return None
 
-        if self.i_am_master and self.controller is None:
-            # Probe for external controller if none is attached (yet)
-            self.probe_controller()
-            pass
-
         good = self.isGood()
         temperr = self.temp_error
 
@@ -331,42 +760,324 @@ class TrafficLightGroup(TrafficLight):
         self.setTempError(temperr)
         self.state = source.state
         self.lamp_currents = self.local.lamp_currents + self.remote.lamp_currents
+        self.publishState()
 
     def setTempError(self, state):
         self.temp_error = state
         self.sendUpdate()
 
+    def publishState(self):
+        # give_way and temp_error are changed from several
+        # places, journal transitions where they get published
+        if (self.give_way, self.temp_error) != self.journaled:
+            if self.give_way != self.journaled[0]:
+                self.journalEvent(journal.GIVE_WAY, self.give_way)
+            if self.temp_error != self.journaled[1]:
+                self.journalEvent(journal.TEMP_ERROR, self.temp_error)
+            self.journaled = (self.give_way, self.temp_error)
+        return TrafficLight.publishState(self)
+
     def sendUpdate(self):
         self.local.setGreen(self.give_way)
         self.local.setTempError(self.temp_error)
         # Try to update the manual controller
         if self.controller is not None:
             self.controller.sendUpdate()
+        self.publishState()
 
     def isGood(self):
         if False in [self.remote.seen(), self.local.seen()]:
             if not self.remote.seen():
-                self.logger.debug("Remote not seen!")
+                self.logger.debug("Remote not seen for {age:.1f}s, maxage {maxage:.1f}s".format(
+                                  **self.remote.freshness()))
             if not self.local.seen():
-                self.logger.debug("Local not seen!")
+                self.logger.debug("Local not seen for {age:.1f}s, maxage {maxage:.1f}s".format(
+                                  **self.local.freshness()))
             return False
         # In transistions, disregard state divergence for a while
         if self.remote.give_way != self.local.give_way:
             if self.start_diverge is None:
                 self.start_diverge = time()
+                self.journalEvent(journal.DIVERGE_START, self.local.give_way)
             if (time() - self.start_diverge) > self.max_diverge:
                 return "maxdiverge"
                 return False
             return None
-        else:
+        elif self.start_diverge is not None:
             self.start_diverge = None
+            self.journalEvent(journal.DIVERGE_END, self.local.give_way)
         if 9 in [self.local.state, self.remote.state]:
             # If an error was detected on either side, fail here, too
             return False
         return True
 
 
+class TrafficLightJunction(CheckedLight):
+    '''
+    Controls a site with any number of approaches.
+
+    members are the lights of all approaches, phases (comma
+    separated lists of members) the approaches given way
+    together, by default one after the other. Each phase gives
+    way for green seconds (one value or one per phase), between
+    phases all approaches are closed for clearance seconds. The
+    next phase only starts when all other members report being
+    closed.
+
+    All members are checked in one pass every check_interval
+    seconds or when one of them changes. If one is not seen,
+    reports an error or does not follow its command within
+    max_diverge seconds, all members are closed with temporary
+    error until all are good again.
+
+    Members which are local lights are switched directly. For
+    every member a light <name>_<member> shows its command, the
+    unit at a remote approach follows it as the remote light of
+    a slave group. Writing give_way false holds all approaches
+    closed, true resumes the phase cycle.
+
+    The give_way of a local light is only its last command, so
+    local members are checked by their reported state, peers by
+    the give_way they report.
+    '''
+    # Reported states of local lights (see TrafficLightDummy.step)
+    green_state = 3
+    red_state = 5
+    error_state = 8
+
+    @classmethod
+    def open(cls, name, members, phases=None, green=30, clearance=5,
+             max_diverge=10, group_key=None, check_interval=.25):
+        members = members.split()
+        if phases is None:
+            phases = [[x] for x in members]
+        else:
+            phases = [x.split() for x in phases.split(",")]
+        for phase in phases:
+            for member in phase:
+                if member not in members:
+                    raise ValueError("Phase member {} is no member".format(member))
+        green = [float(x) for x in str(green).split()]
+        if len(green) == 1:
+            green = green * len(phases)
+        elif len(green) != len(phases):
+            raise ValueError("Need one green time or one per phase")
+        r = cls(name, members, phases, green, float(clearance), float(max_diverge),
+                group_key, float(check_interval))
+        r.setLogger(logging.getLogger(name))
+        return r
+
+    def __init__(self, name, members, phases, green, clearance=5, max_diverge=10,
+                 group_key=None, check_interval=.25):
+        CheckedLight.__init__(self, check_interval)
+        self.member_names = members
+        self.member_lights = []
+        self.phases = [set(members.index(x) for x in phase) for phase in phases]
+        self.green = green
+        self.clearance = clearance
+        self.max_diverge = max_diverge
+        self.setGroupKey(group_key)
+        self.web_writeable = True
+        # Start with a clearance interval before the first phase
+        self.phase = len(phases) - 1
+        self.phase_state = "clearance"
+        self.phase_since = time()
+        # (give_way, temp_error) per member
+        self.commands = [(False, False)] * len(members)
+        self.diverge_since = [None] * len(members)
+        self.bad = []
+        self.views = [TrafficLightJunctionCommand(self, i) for i in range(len(members))]
+        self.view_names = ["{}_{}".format(name, x) for x in members]
+
+    def members(self):
+        return dict(zip(self.view_names, self.views))
+
+    def dereference(self, names):
+        lights = []
+        for name in self.member_names:
+            if name not in names:
+                raise ValueError("Cannot find name {} for member.".format(name))
+            lights.append(names[name])
+        for light in self.member_lights:
+            light.unsubscribe(self.on_member_changed)
+        self.member_lights = lights
+        for (light, view) in zip(lights, self.views):
+            light.setGroupKey(self.group_key)
+            view.setGroupKey(self.group_key)
+            light.subscribe(self.on_member_changed)
+        self.dereferenced = True
+
+    def references(self):
+        return list(self.member_names)
+
+    def stop(self):
+        CheckedLight.stop(self)
+        for light in self.member_lights:
+            light.unsubscribe(self.on_member_changed)
+
+    def on_member_changed(self, light):
+        self.scheduleCheck()
+
+    def seen(self):
+        # Alive while checking
+        return (time() - self.last_seen) < self.maxage
+
+    def isGood(self):
+        return self.seen() and not self.bad
+
+    def setGreen(self, give_way):
+        assert type(give_way) in (bool, int)
+        self.give_way = bool(give_way)
+        self.scheduleCheck()
+
+    def sendUpdate(self):
+        self.scheduleCheck()
+
+    def isClosed(self, member, state):
+        '''
+        Whether a member reports its approach closed.
+        '''
+        if member.peer:
+            return not member.give_way
+        return state == self.red_state
+
+    def follows(self, i, member, state):
+        '''
+        Whether a member reports what it was commanded.
+        '''
+        (give_way, temp_error) = self.commands[i]
+        if member.peer:
+            return bool(member.give_way) == give_way
+        if temp_error:
+            return state == self.error_state
+        return state == (self.green_state if give_way else self.red_state)
+
+    def enter(self, phase_state, now):
+        if phase_state != self.phase_state:
+            self.phase_state = phase_state
+            self.phase_since = now
+            self.logger.info("Phase {} {}".format(self.phase, phase_state))
+
+    def check(self):
+        '''
+        Checks all members, advances the phase cycle and
+        commands the members accordingly.
+        '''
+        if not self.dereferenced:
+            return
+        now = time()
+        self.last_seen = now
+        bad = []
+        states = []
+        voltages = []
+        for (i, member) in enumerate(self.member_lights):
+            try:
+                state = int(member.state)
+            except (ValueError, TypeError):
+                state = 99
+            states.append(state)
+            try:
+                voltages.append(float(member.batt_voltage))
+            except (ValueError, TypeError):
+                pass
+            if not member.seen() or state == 9:
+                bad.append(i)
+            elif not self.follows(i, member, state):
+                if self.diverge_since[i] is None:
+                    self.diverge_since[i] = now
+                elif now - self.diverge_since[i] > self.max_diverge:
+                    bad.append(i)
+            else:
+                self.diverge_since[i] = None
+        if bad and not self.bad:
+            self.logger.error("Temporary error, bad members: {}".format(
+                              [self.member_names[i] for i in bad]))
+        self.bad = bad
+
+        if bad:
+            self.enter("error", now)
+        elif not self.give_way:
+            self.enter("hold", now)
+        elif self.phase_state in ("error", "hold"):
+            self.enter("clearance", now)
+        elif self.phase_state == "green":
+            if now - self.phase_since >= self.green[self.phase]:
+                self.enter("clearance", now)
+        elif now - self.phase_since >= self.clearance:
+            following = (self.phase + 1) % len(self.phases)
+            # Only when all conflicting approaches are closed
+            if all(self.isClosed(member, states[i]) for (i, member) in enumerate(self.member_lights)
+                   if i not in self.phases[following]):
+                self.phase = following
+                self.enter("green", now)
+
+        opened = self.phases[self.phase] if self.phase_state == "green" else ()
+        self.temp_error = bool(bad)
+        for (i, member) in enumerate(self.member_lights):
+            self.commands[i] = (i in opened, self.temp_error)
+            if not member.peer:
+                member.setGreen(self.commands[i][0])
+                member.setTempError(self.commands[i][1])
+            self.views[i].update()
+
+        # The worst of all members
+        self.state = max(states) if states else 99
+        self.batt_voltage = min(voltages) if voltages else 0
+        self.lamp_currents = [x for member in self.member_lights for x in member.lamp_currents]
+        self.publishState()
+
+    def statistics(self):
+        stats = TrafficLight.statistics(self)
+        stats.update({"phase": self.phase,
+                      "phase_state": self.phase_state,
+                      "phase_age": time() - self.phase_since,
+                      "bad": [self.member_names[i] for i in self.bad],
+                      "commands": {name: {"give_way": give_way, "temp_error": temp_error}
+                                   for (name, (give_way, temp_error))
+                                   in zip(self.member_names, self.commands)},
+                      })
+        return stats
+
+
+class TrafficLightJunctionCommand(TrafficLight):
+    '''
+    State of a junction member together with the command
+    of the junction for it.
+    '''
+    keep_history = False
+
+    def __init__(self, junction, index):
+        TrafficLight.__init__(self)
+        self.junction = junction
+        self.index = index
+
+    def seen(self):
+        return self.junction.seen()
+
+    def update(self):
+        member = self.junction.member_lights[self.index]
+        (self.state, self.batt_voltage, self.lamp_currents) = (member.state,
+                                                               member.batt_voltage,
+                                                               member.lamp_currents)
+        (self.give_way, self.temp_error) = self.junction.commands[self.index]
+        self.last_seen = self.junction.last_seen
+        self.publishState()
+
+
 class TrafficLightDummy(TrafficLight):
+    # Lamp currents the dummy reports in each state
+    currents = {
+        0: [60, 0, 0],
+        1: [60, 60, 0],
+        2: [60, 60, 60],
+        3: [0, 0, 60],
+        4: [0, 60, 0],
+        5: [60, 0, 0],
+        6: [60, 60, 0],
+        8: [0, 30, 0],
+        9: [0, 25, 0],
+        }
+
     @classmethod
     def open(cls, name, fail_probability):
         r = cls(float(fail_probability))
@@ -375,8 +1086,8 @@ class TrafficLightDummy(TrafficLight):
 
     def __init__(self, fail_probability):
         TrafficLight.__init__(self)
-        self.fail_loop = task.LoopingCall(self.simulateFailures)
-        self.run_loop = task.LoopingCall(self.run)
+        self.fail_loop = TimedLoopingCall(self.simulateFailures)
+        self.run_loop = TimedLoopingCall(self.run)
         self.fail_probability = fail_probability
         self.state = 0
         self.fail_comm = False
@@ -385,6 +1096,15 @@ class TrafficLightDummy(TrafficLight):
         self.fail_loop.start(.5) .addErrback(self.error)
         self.run_loop.start(1) .addErrback(self.error)
 
+    def retune(self, options):
+        if "fail_probability" in options:
+            self.fail_probability = float(options["fail_probability"])
+        return set(options) - {"fail_probability"}
+
+    def stop(self):
+        stop_loop(self.fail_loop)
+        stop_loop(self.run_loop)
+
     def sendUpdate(self):
         if self.read_only:
             self.logger.debug("Read-only: No update:")
@@ -414,34 +1134,565 @@ class TrafficLightDummy(TrafficLight):
         if self.fail_lamp:
             self.state = 9
         self.logger.debug("state={} temp_error={}".format(self.state, self.temp_error))
-        if self.state < 3:
-            self.state += 1
-        elif self.state == 5:
-            if self.give_way:
-                self.state = 6
-        elif self.state == 6:
-                self.state = 3
-        elif self.state == 3:
-            if not self.give_way:
-                self.state = 4
-        elif self.state == 4:
-            self.state = 5
-        elif self.state == 8 and self.temp_error == False:
-            self.state = 3
         if self.temp_error:
             self.logger.warning("Got temporary error")
-            self.state = 8
-        self.lamp_currents = {
-            0: [60, 0, 0],
-            1: [60, 60, 0],
-            2: [60, 60, 60],
-            3: [0, 0, 60],
-            4: [0, 60, 0],
-            5: [60, 0, 0],
-            6: [60, 60, 0],
-            8: [0, 30, 0],
-            9: [0, 25, 0],
-            }[self.state]
+        self.state = self.step(self.state, self.give_way, self.temp_error)
+        self.lamp_currents = self.currents[self.state]
+        self.publishState()
+
+    @staticmethod
+    def step(state, give_way, temp_error):
+        '''
+        Next state of the simulated state machine.
+        '''
+        if state < 3:
+            state += 1
+        elif state == 5:
+            if give_way:
+                state = 6
+        elif state == 6:
+                state = 3
+        elif state == 3:
+            if not give_way:
+                state = 4
+        elif state == 4:
+            state = 5
+        elif state == 8 and temp_error == False:
+            state = 3
+        if temp_error:
+            state = 8
+        return state
+
+
+class TrafficLightFleet(TrafficLight):
+    '''
+    Simulates count dummy traffic lights (see TrafficLightDummy)
+    in one shared tick, for load tests of groups and the web
+    interface.
+
+    The fields of all members are kept in arrays and stepped
+    together every interval seconds, vectorized if NumPy is
+    available. Members are lights named prefix (the name of the
+    fleet by default) followed by their number, e.g. sim0 ...
+    sim9999, which can be used in groups like any other light.
+    The fleet itself is good while ticking, its statistics count
+    the members per state.
+    '''
+    # States of the simulated state machine are 0..states-1
+    states = 10
+
+    @classmethod
+    def open(cls, name, count, fail_probability=0, interval=1, prefix=None):
+        r = cls(int(count), float(fail_probability), float(interval),
+                name if prefix is None else prefix)
+        r.setLogger(logging.getLogger(name))
+        return r
+
+    def __init__(self, count, fail_probability=0, interval=1, prefix="sim"):
+        TrafficLight.__init__(self)
+        self.count = count
+        self.interval = interval
+        # Dummies draw their failures every .5 s
+        self.fail_probability = 1 - (1 - fail_probability) ** (interval / .5)
+        self.tick_duration = None
+        self.tick_max = 0.
+        self.state = 0
+        # Next state by state, give_way and temp_error, so
+        # all members are stepped by looking up a table.
+        transitions = [TrafficLightDummy.step(state, give_way, temp_error)
+                       for state in range(self.states)
+                       for give_way in (0, 1)
+                       for temp_error in (0, 1)]
+        currents = [TrafficLightDummy.currents.get(state, [0, 0, 0])
+                    for state in range(self.states)]
+        # Flags are kept as bytes, so they can be used as index
+        if numpy is not None:
+            self.transitions = numpy.array(transitions, dtype=numpy.uint8).reshape(self.states, 2, 2)
+            self.currents = numpy.array(currents, dtype=numpy.uint16)
+            self.member_state = numpy.zeros(count, dtype=numpy.uint8)
+            self.member_give_way = numpy.ones(count, dtype=numpy.uint8)
+            self.member_temp_error = numpy.zeros(count, dtype=numpy.uint8)
+            self.fail_lamp = numpy.zeros(count, dtype=numpy.uint8)
+            self.fail_comm = numpy.zeros(count, dtype=numpy.uint8)
+            self.member_voltage = numpy.zeros(count, dtype=numpy.float64)
+            self.member_seen = numpy.zeros(count, dtype=numpy.float64)
+            self.member_good = numpy.zeros(count, dtype=numpy.uint8)
+        else:
+            self.transitions = transitions
+            self.currents = currents
+            self.member_state = array('B', bytes(count))
+            self.member_give_way = array('B', b"\x01" * count)
+            self.member_temp_error = array('B', bytes(count))
+            self.fail_lamp = array('B', bytes(count))
+            self.fail_comm = array('B', bytes(count))
+            self.member_voltage = array('d', [0.]) * count
+            self.member_seen = array('d', [0.]) * count
+            self.member_good = array('B', bytes(count))
+        self.member_lights = [TrafficLightFleetMember(self, i) for i in range(count)]
+        self.member_names = ["{}{}".format(prefix, i) for i in range(count)]
+        self.tick_loop = TimedLoopingCall(self.tick)
+        self.tick_loop.start(interval).addErrback(log.err)
+
+    def setLogger(self, logger):
+        TrafficLight.setLogger(self, logger)
+        # One logger for all, members hardly log anything
+        for member in self.member_lights:
+            member.setLogger(logger)
+
+    def members(self):
+        return dict(zip(self.member_names, self.member_lights))
+
+    def stop(self):
+        stop_loop(self.tick_loop)
+
+    def tick(self):
+        started = time()
+        if numpy is not None:
+            changed = self.stepVectorized(started)
+        else:
+            changed = self.stepLoop(started)
+        self.last_seen = started
+        # Only members whose state or liveness changed are
+        # published. The battery voltage alone changes every
+        # tick, it is picked up whenever they are read (see
+        # getSnapshot) or published anyway.
+        for i in changed:
+            self.member_lights[i].publishState()
+        self.publishState()
+        self.tick_duration = time() - started
+        self.tick_max = max(self.tick_max, self.tick_duration)
+
+    def stepVectorized(self, now):
+        '''
+        Steps all members, returns the indexes of those whose
+        state or liveness changed.
+        '''
+        previous = self.member_state.copy()
+        failing = numpy.flatnonzero(numpy.random.random_sample(self.count) < self.fail_probability)
+        if len(failing):
+            self.fail_lamp[failing] = numpy.random.random_sample(len(failing)) > .5
+            self.fail_comm[failing] = numpy.random.random_sample(len(failing)) > .5
+            self.logger.info("Failures of {} members changed".format(len(failing)))
+        self.member_seen[self.fail_comm == 0] = now
+        state = numpy.where(self.fail_lamp != 0, 9, self.member_state)
+        self.member_state[:] = self.transitions[state, self.member_give_way, self.member_temp_error]
+        self.member_voltage[:] = 12 + numpy.random.random_sample(self.count) * 1.5
+        good = ((now - self.member_seen) < self.maxage) & (self.member_state != 9)
+        changed = numpy.flatnonzero((self.member_state != previous) | (good != self.member_good))
+        self.member_good[:] = good
+        return changed
+
+    def stepLoop(self, now):
+        rand = random.random
+        p = self.fail_probability
+        transitions = self.transitions
+        (states, give_way, temp_error) = (self.member_state, self.member_give_way, self.member_temp_error)
+        (fail_lamp, fail_comm) = (self.fail_lamp, self.fail_comm)
+        (seen, goods, oldest) = (self.member_seen, self.member_good, now - self.maxage)
+        failing = 0
+        changed = []
+        for i in range(self.count):
+            if rand() < p:
+                fail_lamp[i] = rand() > .5
+                fail_comm[i] = rand() > .5
+                failing += 1
+            if not fail_comm[i]:
+                seen[i] = now
+            previous = states[i]
+            state = transitions[(9 if fail_lamp[i] else previous) * 4 + give_way[i] * 2 + temp_error[i]]
+            states[i] = state
+            self.member_voltage[i] = 12 + rand() * 1.5
+            good = seen[i] > oldest and state != 9
+            if state != previous or good != goods[i]:
+                goods[i] = good
+                changed.append(i)
+        if failing:
+            self.logger.info("Failures of {} members changed".format(failing))
+        return changed
+
+    def statistics(self):
+        stats = TrafficLight.statistics(self)
+        if numpy is not None:
+            per_state = numpy.bincount(self.member_state, minlength=self.states).tolist()
+            good = int(numpy.count_nonzero(self.member_good))
+        else:
+            per_state = [0] * self.states
+            for state in self.member_state:
+                per_state[state] += 1
+            good = sum(self.member_good)
+        stats.update({"members": self.count,
+                      "good": good,
+                      "states": per_state,
+                      "tick_duration": self.tick_duration,
+                      "tick_max": self.tick_max,
+                      })
+        return stats
+
+
+def fleet_field(name, kind):
+    '''
+    Property of a fleet member stored in the fleet's array name.
+    '''
+    def get(self):
+        return kind(getattr(self.fleet, name)[self.index])
+
+    def set(self, value):
+        getattr(self.fleet, name)[self.index] = value
+    return property(get, set)
+
+
+class TrafficLightFleetMember(TrafficLight):
+    '''
+    A single light of a TrafficLightFleet, its fields live
+    in the arrays of the fleet.
+    '''
+    # A history of 2 MB per member does not scale
+    keep_history = False
+
+    state = fleet_field("member_state", int)
+    give_way = fleet_field("member_give_way", bool)
+    temp_error = fleet_field("member_temp_error", bool)
+    batt_voltage = fleet_field("member_voltage", float)
+    last_seen = fleet_field("member_seen", float)
+
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.index = index
+        TrafficLight.__init__(self)
+        self.state = 0
+        self.give_way = True
+
+    @property
+    def lamp_currents(self):
+        return [int(x) for x in self.fleet.currents[self.state]]
+
+    @lamp_currents.setter
+    def lamp_currents(self, value):
+        # They follow from the state
+        pass
+
+    def sendUpdate(self):
+        pass
+
+    def reset(self):
+        self.state = 0
+        self.fleet.fail_lamp[self.index] = 0
+        self.fleet.fail_comm[self.index] = 0
+
+
+class LinkStatistics(object):
+    '''
+    Round trip time and error statistics of the link
+    to a remote traffic light.
+    '''
+    # Weight of a new sample in the smoothed RTT
+    alpha = .125
+    # Number of recent RTTs percentiles are taken from
+    recent_size = 100
+
+    def __init__(self):
+        self.recent = deque(maxlen=self.recent_size)
+        self.requests = 0
+        self.answers = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.late = 0
+        self.skipped = 0
+        self.hedged = 0
+        self.rtt_last = None
+        self.rtt_avg = None
+        self.rtt_var = None
+        self.rtt_min = None
+        self.rtt_max = None
+        self.rtt = Histogram()
+
+    def answer(self, rtt):
+        self.answers += 1
+        self.rtt.observe(rtt)
+        self.recent.append(rtt)
+        self.rtt_last = rtt
+        if self.rtt_avg is None:
+            (self.rtt_avg, self.rtt_var) = (rtt, rtt / 2)
+            (self.rtt_min, self.rtt_max) = (rtt, rtt)
+        else:
+            self.rtt_var += self.alpha * (abs(rtt - self.rtt_avg) - self.rtt_var)
+            self.rtt_avg += self.alpha * (rtt - self.rtt_avg)
+            self.rtt_min = min(self.rtt_min, rtt)
+            self.rtt_max = max(self.rtt_max, rtt)
+
+    def percentile(self, p):
+        '''
+        Nearest-rank percentile of the recent RTTs, None
+        without any.
+        '''
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[max(0, min(len(values) - 1, int(p / 100. * len(values) + .5) - 1))]
+
+    def error_rate(self):
+        if self.requests > 0:
+            return 100. * (self.errors + self.timeouts) / self.requests
+        else:
+            return None
+
+    def as_dict(self):
+        return {"requests": self.requests,
+                "answers": self.answers,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "late": self.late,
+                "skipped": self.skipped,
+                "hedged": self.hedged,
+                "error_rate": self.error_rate(),
+                "rtt_last": self.rtt_last,
+                "rtt_avg": self.rtt_avg,
+                "rtt_var": self.rtt_var,
+                "rtt_min": self.rtt_min,
+                "rtt_max": self.rtt_max,
+                "rtt_p95": self.percentile(95),
+                }
+
+
+class FreshnessEstimator(object):
+    '''
+    Estimates when the state in an answer of a remote was
+    current and how old it may get before the remote counts
+    as not seen.
+
+    The clock offset of the remote is taken NTP style from
+    the server time ("_time") in signed answers, using the
+    answer with the lowest RTT of the last few. The state was
+    current at that time, at the latest when the answer
+    arrived and not before the request was sent.
+
+    The age of the last state whenever a new one arrives is
+    tracked like an RTT, maxage is its average plus four
+    times its deviation within maxage_min and maxage_max.
+    Until min_samples arrived, maxage_min is used. Ages above
+    twice the current maxage are outages and ignored.
+    '''
+    alpha = .125
+    beta = .25
+    # Answers the clock offset is picked from
+    offset_samples = 8
+
+    def __init__(self, maxage_min=4, maxage_max=8, min_samples=8):
+        self.maxage_min = maxage_min
+        self.maxage_max = maxage_max
+        self.min_samples = min_samples
+        # (rtt, offset) of recent answers
+        self.samples = deque(maxlen=self.offset_samples)
+        # Remote clock minus ours, and the RTT it was taken with
+        self.offset = None
+        self.offset_rtt = None
+        self.age_avg = None
+        self.age_var = None
+        self.count = 0
+        self.outages = 0
+
+    def stamp(self, sent, received, remote_time):
+        '''
+        Local time the state in an answer signed at remote_time
+        was current. sent excludes the time the request was held.
+        '''
+        self.samples.append((received - sent, remote_time - (sent + received) / 2.))
+        (self.offset_rtt, self.offset) = min(self.samples)
+        return min(received, max(sent, remote_time - self.offset))
+
+    def arrived(self, age):
+        '''
+        Records the age the previous state reached when a
+        new one arrived.
+        '''
+        if age > 2 * self.maxage():
+            self.outages += 1
+            return
+        self.count += 1
+        if self.age_avg is None:
+            (self.age_avg, self.age_var) = (age, age / 2)
+        else:
+            self.age_var += self.beta * (abs(age - self.age_avg) - self.age_var)
+            self.age_avg += self.alpha * (age - self.age_avg)
+
+    def maxage(self):
+        if self.count < self.min_samples:
+            return self.maxage_min
+        return min(self.maxage_max, max(self.maxage_min, self.age_avg + 4 * self.age_var))
+
+    def as_dict(self):
+        return {"maxage": self.maxage(),
+                "clock_offset": self.offset,
+                "clock_offset_rtt": self.offset_rtt,
+                "age_avg": self.age_avg,
+                "age_var": self.age_var,
+                "outages": self.outages,
+                }
+
+
+class RemotePath(object):
+    '''
+    One URL of a remote traffic light, with the statistics
+    of its link.
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.link = LinkStatistics()
+        # Failed requests since the last answer
+        self.failures = 0
+        # Answers of this path that were used
+        self.wins = 0
+
+    def rank(self):
+        '''
+        Sort key, working and fast paths first.
+        '''
+        rtt = self.link.rtt_avg
+        return (self.failures, rtt if rtt is not None else float("inf"))
+
+    def as_dict(self):
+        result = self.link.as_dict()
+        result.update({"url": self.url,
+                       "failures": self.failures,
+                       "wins": self.wins,
+                       })
+        return result
+
+
+class PollRound(object):
+    '''
+    One poll of a remote, sent on one or more paths. The
+    first valid answer is used.
+    '''
+
+    def __init__(self, starttime, challenge, args, timeout, held):
+        self.starttime = starttime
+        self.challenge = challenge
+        self.args = args
+        self.timeout = timeout
+        # Seconds the remote may hold the requests
+        self.held = held
+        # Request id -> path, of the requests still running
+        self.requests = {}
+        self.tried = []
+        # Timer sending on the next path
+        self.hedge = None
+
+    def cancelHedge(self):
+        if self.hedge is not None and self.hedge.active():
+            self.hedge.cancel()
+        self.hedge = None
+
+
+class CommandPush(object):
+    '''
+    Pushes give_way and temp_error of a master's light to the
+    light representing it on the slave, so the slave doesn't
+    have to wait for its next poll.
+
+    Commands are sealed with the group key (see
+    TransportWrapper.seal), numbered with the state version of
+    the light. The slave acknowledges each with its number.
+    Without acknowledgement within timeout seconds the command
+    is sent again, at most retries times, unless a newer one
+    replaced it. Polling by the slave stays the fallback.
+    '''
+
+    def __init__(self, url, timeout=1, retries=5):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.agent = Agent(reactor, connectTimeout=timeout, pool=self.pool)
+        self.wrapper = None
+        # Tells our pushes apart from those before a restart
+        self.instance = random.getrandbits(32)
+        self.logger = logging.getLogger()
+        # Command waiting for its acknowledgement
+        self.pending = None
+        self.attempts = 0
+        self.sent_at = None
+        self.request = None
+        self.pushes = 0
+        self.retransmits = 0
+        self.acked = 0
+        self.failed = 0
+        self.ack_latency = Histogram()
+
+    def setGroupKey(self, key):
+        self.wrapper = TransportWrapper(key)
+
+    def push(self, seq, give_way, temp_error):
+        superseded = self.request
+        self.pending = (seq, {"give_way": give_way, "temp_error": temp_error})
+        self.attempts = 0
+        self.sent_at = time()
+        self.pushes += 1
+        if superseded is not None:
+            # Its acknowledgement doesn't matter any more
+            superseded.cancel()
+        self.send()
+
+    def send(self):
+        (seq, message) = self.pending
+        self.attempts += 1
+        body = self.wrapper.seal(message, seq, self.instance, "compact")
+        req = self.agent.request(b"POST", bytes((self.url + "?auth=sealed").encode("ascii")),
+                                 Headers({b"content-type": [b"text/plain"]}),
+                                 FileBodyProducer(BytesIO(body.encode("utf8"))))
+        req.addTimeout(self.timeout, reactor)
+        req.addCallback(readBody)
+        req.addCallback(self.on_ack, seq)
+        req.addErrback(self.on_error, seq)
+        self.request = req
+
+    def on_ack(self, body, seq):
+        ack = json.loads(body.decode("utf8"))
+        if ack.get("instance") != self.instance or self.pending is None or ack.get("ack") != seq:
+            raise ValueError("Unexpected acknowledgement {}".format(ack))
+        if seq != self.pending[0]:
+            return
+        self.ack_latency.observe(time() - self.sent_at)
+        self.acked += 1
+        self.pending = None
+        self.request = None
+
+    def on_error(self, failure, seq):
+        if failure.check(defer.CancelledError) or self.pending is None or seq != self.pending[0]:
+            # Superseded by a newer command
+            return
+        self.request = None
+        if self.attempts > self.retries:
+            self.logger.warning("Push of version {} not acknowledged: {}".format(
+                                seq, failure.getErrorMessage()))
+            self.failed += 1
+            self.pending = None
+            return
+        self.retransmits += 1
+        self.send()
+
+    def stop(self):
+        self.pending = None
+        if self.request is not None:
+            self.request.cancel()
+        self.pool.closeCachedConnections()
+
+    def statistics(self):
+        return {"url": self.url,
+                "pushes": self.pushes,
+                "retransmits": self.retransmits,
+                "acked": self.acked,
+                "failed": self.failed,
+                "pending": self.pending is not None,
+                }
+
+    def metrics(self):
+        return {"push_total": self.pushes,
+                "push_retransmits_total": self.retransmits,
+                "push_failed_total": self.failed,
+                "push_ack_seconds": self.ack_latency,
+                }
 
 
 class TrafficLightRemote(TrafficLight):
@@ -453,108 +1704,619 @@ class TrafficLightRemote(TrafficLight):
     better security.
 
     Note that only groups can be written remotely!!
+
+    In mode "poll" the remote is asked every interval seconds.
+    In mode "longpoll" the remote holds each request for up to
+    hold seconds until its state changes, the next request is
+    sent as soon as an answer arrived. The interval then only
+    restarts polling after errors.
+
+    Connections are kept alive and reused. Requests time out
+    after timeout seconds (plus hold in longpoll mode), at most
+    max_inflight polls are running at the same time. While
+    the remote fails, polling backs off exponentially up to
+    max_backoff seconds.
+
+    url may list several URLs of the remote, separated by
+    spaces, e.g. over different networks. Each poll goes to
+    the path answering most reliably and fastest. If it hasn't
+    answered within its 95th percentile RTT, or failed, the
+    poll is sent on the next path as well. The first valid
+    answer is used and the other requests of the poll are
+    cancelled.
+
+    With auth "challenge" every answer is signed for the
+    challenge of its request. With auth "window" the remote
+    hands out one sealed answer per state, which is accepted
+    if signed within window seconds (needs synced clocks).
+
+    The remote counts as seen for an adaptive maxage between
+    maxage_min and maxage_max seconds, growing with the jitter
+    of its reports (see FreshnessEstimator). With auth
+    "challenge" they are dated by the time the remote signed
+    them.
     '''
+    modes = ("poll", "longpoll")
+    auths = ("challenge", "window")
+    peer = True
+    # Minimum delay before a poll is sent on another path
+    hedge_min = .01
 
     @classmethod
-    def open(cls, name, url, interval):
-        r = cls(url, float(interval))
+    def open(cls, name, url, interval, mode="poll", hold=2, timeout=2,
+             max_inflight=4, max_backoff=8, auth="challenge", window=3,
+             maxage_min=4, maxage_max=8):
+        mode = mode.strip().lower()
+        if mode not in cls.modes:
+            raise ValueError("Unknown mode {}, valid would be {}".format(mode, cls.modes))
+        auth = auth.strip().lower()
+        if auth not in cls.auths:
+            raise ValueError("Unknown auth {}, valid would be {}".format(auth, cls.auths))
+        r = cls(url, float(interval), mode, float(hold), float(timeout),
+                int(max_inflight), float(max_backoff), auth, float(window),
+                float(maxage_min), float(maxage_max))
         r.setLogger(logging.getLogger(name))
         return r
 
-    def __init__(self, url, interval):
+    def __init__(self, url, interval, mode="poll", hold=2, timeout=2,
+                 max_inflight=4, max_backoff=8, auth="challenge", window=3,
+                 maxage_min=4, maxage_max=8):
         TrafficLight.__init__(self)
-        self.poll_loop = task.LoopingCall(self.poll_remote)
-        self.agent = Agent(reactor)
-        self.remote_url = url
+        self.estimator = FreshnessEstimator(maxage_min, maxage_max)
+        self.maxage = self.estimator.maxage()
+        self.poll_loop = TimedLoopingCall(self.poll_remote)
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_inflight
+        self.agent = Agent(reactor, connectTimeout=timeout, pool=self.pool)
+        self.setPaths(url)
+        self.interval = interval
+        self.mode = mode
+        self.hold = hold
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.max_backoff = max_backoff
+        self.auth = auth
+        self.window = window
+        self.remote_version = None
+        # Request id -> (starttime, request)
         self.running_requests = {}
-        self.error_count = 0
-        self.request_count = 0
+        # Polls still waiting for an answer
+        self.rounds = []
+        self.request_ids = itertools.count()
+        # Totals over all paths
+        self.link = LinkStatistics()
+        self.failures = 0
+        self.backoff_until = 0
+        # Last command pushed by the remote, see pushed()
+        self.last_push = None
+        self.pushed_at = None
+        self.pushed_version = None
+        self.push_received = 0
+        self.push_duplicates = 0
+        self.push_rejected = 0
         self.poll_loop.start(interval).addErrback(log.err)
 
-    def update_answer_handler(self, response):
-        d = readBody(response)
-        # TODO maybe move it until validation?
-        self.error_count = 0
-        d.addCallback(self.on_update_answer_received)
-        d.addErrback(log.err)
-        return d
-
-    def on_update_answer_received(self, data):
-        if not data.strip() == "ok":
-            logging.error("Something went wrong trying to update remote.. Answer was:{}".format(data.strip()))
-
-    def poll_error(self, failure, starttime):
+    def setPaths(self, url):
+        urls = url.split()
+        if not urls:
+            raise ValueError("No url given")
+        self.remote_url = urls[0]
+        self.paths = [RemotePath(x) for x in urls]
+
+    def retune(self, options):
+        rest = set(options)
+        if "mode" in options:
+            mode = options["mode"].strip().lower()
+            if mode not in self.modes:
+                raise ValueError("Unknown mode {}, valid would be {}".format(mode, self.modes))
+            self.mode = mode
+        if "auth" in options:
+            auth = options["auth"].strip().lower()
+            if auth not in self.auths:
+                raise ValueError("Unknown auth {}, valid would be {}".format(auth, self.auths))
+            self.auth = auth
+        for name in ("hold", "max_backoff", "window"):
+            if name in options:
+                setattr(self, name, float(options[name]))
+        for name in ("maxage_min", "maxage_max"):
+            if name in options:
+                setattr(self.estimator, name, float(options[name]))
+        self.maxage = self.estimator.maxage()
+        if "timeout" in options:
+            self.timeout = float(options["timeout"])
+            self.agent = Agent(reactor, connectTimeout=self.timeout, pool=self.pool)
+        if "url" in options:
+            self.setPaths(options["url"])
+            self.remote_version = None
+        rest -= {"mode", "auth", "hold", "max_backoff", "window", "timeout", "url",
+                 "maxage_min", "maxage_max"}
+        # Requests sent with the old settings are of no use
+        self.cancelRequests()
+        if "interval" in options:
+            self.interval = float(options["interval"])
+            rest.discard("interval")
+            restart_loop(self.poll_loop, self.interval)
+        else:
+            self.poll_remote()
+        return rest
+
+    def cancelRequests(self):
+        for poll in self.rounds:
+            poll.cancelHedge()
+        self.rounds = []
+        running = list(self.running_requests.values())
+        # Cancelled requests not in the list are ignored
+        self.running_requests.clear()
+        for (starttime, req) in running:
+            req.cancel()
+
+    def stop(self):
+        stop_loop(self.poll_loop)
+        self.cancelRequests()
+        self.pool.closeCachedConnections()
+
+    def endRound(self, poll, answered=None):
+        '''
+        Cancels the requests of a poll still running. Those sent
+        before the answered one count against their path, so it
+        isn't tried first next time.
         '''
-        When a request fails, clean up the waiting list
+        poll.cancelHedge()
+        if poll in self.rounds:
+            self.rounds.remove(poll)
+        for (request_id, path) in list(poll.requests.items()):
+            (started, req) = self.running_requests.pop(request_id)
+            req.cancel()
+            if answered is not None and started <= answered:
+                path.link.late += 1
+                path.failures += 1
+        poll.requests.clear()
+
+    def poll_error(self, failure, poll, path, request_id):
         '''
-        self.logger.error("Request {} failed: {}".format(starttime, failure))
-        self.error_count += 1
-        del self.running_requests[starttime]
+        When a request fails, clean up the waiting list, try
+        another path and back off if none is left.
+        '''
+        if request_id not in self.running_requests:
+            # Cancelled by ourselves after a newer answer arrived
+            return
+        del self.running_requests[request_id]
+        del poll.requests[request_id]
+        timeout = failure.check(defer.TimeoutError, defer.CancelledError)
+        if failure.check(ResponseNeverReceived):
+            # Cancelled by the timeout while waiting for the answer
+            timeout = any(x.check(defer.CancelledError) for x in failure.value.reasons)
+        for link in (self.link, path.link):
+            if timeout:
+                link.timeouts += 1
+            else:
+                link.errors += 1
+        path.failures += 1
+        self.logger.error("Request {} to {} failed: {}".format(request_id, path.url, failure))
+        if self.nextPath(poll) is not None:
+            # Fail over right away instead of waiting for the hedge
+            poll.cancelHedge()
+            self.hedge(poll)
+            return
+        if poll.requests:
+            # Another path may still answer
+            return
+        self.endRound(poll)
+        self.failures += 1
+        # Capped exponent, a long outage would overflow the float
+        delay = min(self.max_backoff, self.interval * 2 ** min(self.failures, 16))
+        # Jitter, so both sides don't retry in lockstep
+        self.backoff_until = time() + random.uniform(delay / 2, delay)
 
     def error_rate(self):
-        if self.request_count > 0:
-            return 100. * self.error_count / self.request_count
-        else:
-            return None
+        return self.link.error_rate()
+
+    def statistics(self):
+        stats = TrafficLight.statistics(self)
+        stats.update(self.link.as_dict())
+        stats["inflight"] = len(self.rounds)
+        stats["failures"] = self.failures
+        stats["backoff"] = max(0, self.backoff_until - time())
+        stats["paths"] = [x.as_dict() for x in self.paths]
+        stats.update(self.estimator.as_dict())
+        stats["push"] = {"received": self.push_received,
+                         "duplicates": self.push_duplicates,
+                         "rejected": self.push_rejected,
+                         "version": self.pushed_version,
+                         }
+        return stats
+
+    def freshness(self):
+        result = TrafficLight.freshness(self)
+        result.update(self.estimator.as_dict())
+        result["rtt_p95"] = self.link.percentile(95)
+        return result
+
+    def metrics(self):
+        result = TrafficLight.metrics(self)
+        result.update({"poll_requests_total": self.link.requests,
+                       "poll_errors_total": self.link.errors,
+                       "poll_timeouts_total": self.link.timeouts,
+                       "poll_late_total": self.link.late,
+                       "poll_skipped_total": self.link.skipped,
+                       "poll_hedged_total": self.link.hedged,
+                       "poll_rtt_seconds": self.link.rtt,
+                       "maxage_seconds": self.maxage,
+                       "push_received_total": self.push_received,
+                       "push_duplicates_total": self.push_duplicates,
+                       "push_rejected_total": self.push_rejected,
+                       })
+        if self.estimator.offset is not None:
+            result["clock_offset_seconds"] = self.estimator.offset
+        return result
 
     def poll_remote(self):
         '''
         Polls remote host to get its state
         '''
+        if self.mode == "longpoll" and self.rounds:
+            # Still waiting for the remote to change
+            return
+        if time() < self.backoff_until:
+            return
+        if len(self.rounds) >= self.max_inflight:
+            self.link.skipped += 1
+            return
         try:
             # FIXME: might fail on first iteration as transportWrapper is not
             #        yet initialized..
-            self.request_count += 1
-            challenge = self.transportWrapper.makeChallenge()
-            url = self.remote_url + "?" + urllib.parse.urlencode({"challenge": challenge})
-            url = bytes(url.encode("ascii"))
-            starttime = time()
-            req = self.agent.request(b"GET", url)
-            req.addCallback(self.request_handler, challenge, starttime)
-            req.addErrback(self.poll_error, starttime)
-            self.running_requests[starttime] = req
-            self.logger.debug("len(running_requests)={}, age={:0.1f}s, error_rate={:0.2f}%".format(len(self.running_requests), time()-self.last_seen, self.error_rate()))
+            # Remotes not knowing the compact envelope ignore it
+            # and answer in the legacy one.
+            if self.auth == "window":
+                challenge = None
+                args = {"auth": "window", "envelope": "compact"}
+            else:
+                challenge = self.transportWrapper.makeChallenge()
+                args = {"challenge": challenge, "envelope": "compact"}
+            timeout = self.timeout
+            held = 0
+            if self.mode == "longpoll" and self.remote_version is not None:
+                args["since"] = self.remote_version
+                args["timeout"] = self.hold
+                held = self.hold
+            poll = PollRound(time(), challenge, args, timeout + held, held)
+            self.rounds.append(poll)
+            self.send(poll, self.nextPath(poll))
+            self.logger.debug("polls={}, age={:0.1f}s, error_rate={:0.2f}%".format(len(self.rounds), time()-self.last_seen, self.error_rate()))
         except Exception as e:
             self.logger.debug(">>>>{}".format(e))
 
-    def force_set(self, giveway=None, temp_error=None):
+    def nextPath(self, poll):
         '''
-        Can be used to force remote's state to a certain value.
-        Note this may fail if remote is not writable!
+        The best path a poll wasn't sent on yet.
         '''
-        body = {}
-        body['giveway'] = give_way
+        untried = [x for x in self.paths if x not in poll.tried]
+        if not untried:
+            return None
+        return min(untried, key=RemotePath.rank)
 
+    def hedgeDelay(self, path, poll):
+        '''
+        How long to wait for an answer on path before sending
+        on the next one: its 95th percentile RTT, bounded by
+        the timeout.
+        '''
+        p95 = path.link.percentile(95)
+        if p95 is None:
+            p95 = self.timeout / 2
+        return poll.held + min(self.timeout, max(self.hedge_min, p95))
+
+    def send(self, poll, path):
+        url = path.url + "?" + urllib.parse.urlencode(poll.args)
+        url = bytes(url.encode("ascii"))
+        starttime = time()
+        request_id = next(self.request_ids)
+        self.link.requests += 1
+        path.link.requests += 1
+        poll.tried.append(path)
+        poll.requests[request_id] = path
+        self.running_requests[request_id] = (starttime, None)
+        req = self.agent.request(b"GET", url)
+        req.addCallback(self.request_handler, poll, path, request_id, starttime)
+        req.addTimeout(poll.timeout, reactor)
+        req.addErrback(self.poll_error, poll, path, request_id)
+        if request_id in self.running_requests:
+            self.running_requests[request_id] = (starttime, req)
+        if request_id in poll.requests and self.nextPath(poll) is not None:
+            poll.hedge = reactor.callLater(self.hedgeDelay(path, poll), self.hedge, poll)
+
+    def hedge(self, poll):
+        '''
+        Sends a poll without answer on the next path.
+        '''
+        poll.hedge = None
+        path = self.nextPath(poll)
+        if poll not in self.rounds or path is None:
+            return
+        if poll.requests:
+            # Not a failover, the other path is just slow
+            self.link.hedged += 1
+            path.link.hedged += 1
+        self.send(poll, path)
 
-    def request_handler(self, response, challenge, starttime):
+    def pushed(self, raw):
+        '''
+        Takes give_way and temp_error pushed by the remote ahead
+        of the next poll. Repeated pushes are acknowledged again
+        without applying them twice.
+        '''
+        if self.transportWrapper is None:
+            raise ValueError("No group key")
+        try:
+            # Our estimate of the remote's clock, if there is one
+            data = self.transportWrapper.unseal(raw, self.window, self.last_push,
+                                                self.estimator.offset or 0)
+        except (ValueError, KeyError, AttributeError) as e:
+            self.push_rejected += 1
+            raise ValueError(str(e))
+        if not data or "give_way" not in data or "temp_error" not in data:
+            self.push_rejected += 1
+            raise ValueError("Signature invalid or command missing")
+        last = self.last_push
+        self.last_push = data
+        if last is not None and (last["instance"], last["seq"]) == (data["instance"], data["seq"]):
+            self.push_duplicates += 1
+        else:
+            self.push_received += 1
+            self.pushed_at = time()
+            self.pushed_version = data["seq"]
+            self.last_seen = max(self.last_seen, self.pushed_at)
+            (self.give_way, self.temp_error) = (data["give_way"], data["temp_error"])
+            self.publishState()
+        return {"ack": data["seq"], "instance": data["instance"]}
+
+    def request_handler(self, response, poll, path, request_id, starttime):
+        version = response.headers.getRawHeaders(b"x-state-version")
+        if version:
+            version = self.remote_version = int(version[0])
+        else:
+            version = None
+        held = response.headers.getRawHeaders(b"x-held")
+        held = float(held[0]) if held else 0
         d = readBody(response)
-        # TODO maybe move it until validation?
-        self.error_count = 0
-        d.addCallback(self.on_data_received, challenge, starttime)
-        d.addErrback(log.err)
+        d.addCallback(self.on_data_received, poll, path, request_id, starttime, held, version)
         return d
 
-    def on_data_received(self, body, challenge, starttime):
-        if starttime not in self.running_requests:
+    def on_data_received(self, body, poll, path, request_id, starttime, held=0, version=None):
+        if request_id not in self.running_requests:
             # This can only be triggered by a race condition between this
             # function cancelling a request and getting data. Not sure how
             # twisted handled this in the background, just catch it before
             # bad things happen
             self.logger.warning("State data arrived too late, discarding")
+            self.link.late += 1
+            return
+        if (version is not None and self.pushed_version is not None and
+                starttime < self.pushed_at and version < self.pushed_version):
+            # Answered before a newer state was pushed
+            del self.running_requests[request_id]
+            del poll.requests[request_id]
+            self.link.late += 1
+            self.endRound(poll)
+            if self.mode == "longpoll":
+                self.poll_remote()
             return
         self.logger.debug("body={}".format(body))
-        self.from_json(body, challenge)
-        self.last_seen = starttime
-        # Now purge old requests
-        stale_requests = [ started for started in self.running_requests if started < self.last_seen ]
-        for started in stale_requests:
-            self.running_requests[started].cancel()
-            if started in self.running_requests:
-                del self.running_requests[started]
-            self.error_count += 1
+        # Invalid answers raise and count as error of the path
+        if self.auth == "window":
+            data = self.from_json(body, window=self.window)
+        else:
+            data = self.from_json(body, poll.challenge)
+        del self.running_requests[request_id]
+        del poll.requests[request_id]
+        received = time()
+        rtt = received - starttime - held
+        self.link.answer(rtt)
+        path.link.answer(rtt)
+        path.failures = 0
+        path.wins += 1
+        # The first valid answer wins
+        self.endRound(poll, starttime)
+        self.failures = 0
+        self.backoff_until = 0
+        if self.auth == "challenge" and "_time" in data:
+            # Signed for this request, so the time is fresh
+            stamp = self.estimator.stamp(starttime + held, received, data["_time"])
+        elif self.mode == "longpoll":
+            # The request may have been held for a while,
+            # the answer reflects the state at its arrival.
+            stamp = received
+        else:
+            stamp = poll.starttime
+        if self.last_seen > 0:
+            self.estimator.arrived(received - self.last_seen)
+        self.last_seen = max(self.last_seen, stamp)
+        self.maxage = self.estimator.maxage()
+        if self.mode == "longpoll":
+            # Without a version the remote can't hold requests,
+            # leave it to the poll loop then.
+            if self.remote_version is not None:
+                self.poll_remote()
+            return
+        # Now purge polls older than this answer
+        for stale in [x for x in self.rounds if x.starttime < poll.starttime]:
+            self.endRound(stale)
+            self.link.late += 1
+
+
+class TrafficLightUDP(protocol.DatagramProtocol, TrafficLight):
+    '''
+    Interface to a remote traffic light using compact,
+    signed UDP datagrams (see auth.DatagramWrapper).
+
+    Both sides configure a light of this type: it represents
+    the peer's light and at the same time sends the state of
+    the light named in publish to the peer, every interval
+    seconds and whenever it changes. Lost datagrams are simply
+    superseded by the next one.
+    '''
+    peer = True
+
+    @classmethod
+    def open(cls, name, peer, publish, listen=9880, interval=.5, bind=""):
+        (host, port) = peer.rsplit(":", 1)
+        r = cls(host, int(port), publish, float(interval))
+        r.setLogger(logging.getLogger(name))
+        reactor.listenUDP(int(listen), r, interface=bind)
+        return r
+
+    def __init__(self, host, port, publish, interval):
+        TrafficLight.__init__(self)
+        self.peer_host = host
+        self.peer_port = port
+        self.peer_address = None
+        self.publish = publish
+        self.publish_name = publish
+        self.interval = interval
+        self.datagramWrapper = DatagramWrapper(None)
+        self.session = random.getrandbits(32)
+        self.seq = 0
+        self.peer_session = None
+        self.peer_seq = None
+        self.sent = 0
+        self.received = 0
+        self.rejected = 0
+        self.lost = 0
+        self.send_loop = TimedLoopingCall(self.send_state)
+
+    def setGroupKey(self, key):
+        TrafficLight.setGroupKey(self, key)
+        self.datagramWrapper = DatagramWrapper(key)
+
+    def dereference(self, names):
+        if self.publish_name not in names:
+            raise ValueError("Cannot find name {} for publish.".format(self.publish_name))
+        if isinstance(self.publish, TrafficLight):
+            self.publish.unsubscribe(self.on_publish_changed)
+        self.publish = names[self.publish_name]
+        self.publish.subscribe(self.on_publish_changed)
+
+    def references(self):
+        return [self.publish_name]
+
+    def retune(self, options):
+        if "interval" in options:
+            self.interval = float(options["interval"])
+            if self.send_loop.running:
+                restart_loop(self.send_loop, self.interval)
+        return set(options) - {"interval"}
+
+    def stop(self):
+        if isinstance(self.publish, TrafficLight):
+            self.publish.unsubscribe(self.on_publish_changed)
+        if self.transport is not None:
+            return self.transport.stopListening()
+
+    def startProtocol(self):
+        self.send_loop.start(self.interval).addErrback(log.err)
+
+    def stopProtocol(self):
+        if self.send_loop.running:
+            self.send_loop.stop()
+
+    def resolve(self):
+        d = reactor.resolve(self.peer_host)
+        d.addCallback(self.on_resolved)
+        d.addErrback(self.on_resolve_error)
+
+    def on_resolved(self, address):
+        self.peer_address = (address, self.peer_port)
+
+    def on_resolve_error(self, failure):
+        self.logger.error("Cannot resolve {}: {}".format(self.peer_host, failure.getErrorMessage()))
+
+    def on_publish_changed(self, light):
+        self.send_state()
+
+    def send_state(self):
+        if isinstance(self.publish, str):
+            # Not dereferenced yet
+            return
+        if self.peer_address is None:
+            self.resolve()
+            return
+        self.seq += 1
+        packet = self.datagramWrapper.pack(self.session, self.seq, self.publish.status())
+        try:
+            self.transport.write(packet, self.peer_address)
+            self.sent += 1
+        except Exception as e:
+            self.logger.error("Sending to {} failed: {}".format(self.peer_address, e))
+
+    def datagramReceived(self, packet, address):
+        try:
+            (session, seq, data) = self.datagramWrapper.unpack(packet)
+        except ValueError as e:
+            self.logger.info("Rejected datagram from {}: {}".format(address, e))
+            self.rejected += 1
+            return
+        if session != self.peer_session:
+            # The peer restarted. Only switch sessions when the
+            # current one went silent, so replayed datagrams of
+            # old sessions can't interfere with a live one.
+            if self.peer_session is not None and self.seen():
+                self.rejected += 1
+                return
+            self.logger.info("New session {:08x} from {}".format(session, address))
+            self.peer_session = session
+        elif seq <= self.peer_seq:
+            # Duplicate, reordered or replayed
+            self.rejected += 1
+            return
+        else:
+            self.lost += seq - self.peer_seq - 1
+        self.peer_seq = seq
+        self.received += 1
+        (self.state, self.batt_voltage, self.lamp_currents) = (data["state"],
+                                                               data["batt_voltage"],
+                                                               data["lamp_currents"])
+        (self.give_way, self.temp_error) = (data["give_way"], data["temp_error"])
+        self.last_seen = time()
+        self.publishState()
+
+    def statistics(self):
+        stats = TrafficLight.statistics(self)
+        stats.update({"sent": self.sent,
+                      "received": self.received,
+                      "rejected": self.rejected,
+                      "lost": self.lost,
+                      })
+        return stats
+
+    def metrics(self):
+        result = TrafficLight.metrics(self)
+        result.update({"udp_sent_total": self.sent,
+                       "udp_received_total": self.received,
+                       "udp_rejected_total": self.rejected,
+                       "udp_lost_total": self.lost,
+                       })
+        return result
 
 
 class TrafficLightSerial(basic.LineReceiver, TrafficLight):
+    '''
+    Traffic light driven by a PIC on a serial port.
+
+    Commands are coalesced per reactor turn and only sent on
+    changes. serviceWatchdog runs every keepalive / 2 seconds
+    and refreshes all commands if nothing was sent for
+    keepalive seconds, so a PIC which lost a command or was
+    reset gets the current state.
+
+    The link is supervised: without a valid status for
+    rx_timeout seconds (or after a line overflow) the port is
+    reopened, with a pause doubling from rx_timeout up to
+    max_backoff seconds between attempts. With a reset_pin,
+    every reset_after + 1st attempt pulses the PIC's reset
+    through the GPIO sysfs at gpio_root to reset_level for
+    reset_pulse seconds instead. The time from the last status
+    before the outage to the first one after is recorded.
+    '''
 
     delimiter = '\n'.encode('ascii')
 
@@ -567,40 +2329,167 @@ class TrafficLightSerial(basic.LineReceiver, TrafficLight):
 
     baud = 19200
 
+    # Bucket bounds in seconds of the recovery times
+    recovery_buckets = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    # Ports in use by serial traffic lights, these are
+    # never claimed as handheld controller
+    ports = set()
+
+    lines_received = 0
+    lines_garbled = 0
+
     @classmethod
-    def open(cls, name, port, reset_pin=None, reactor=reactor):
+    def open(cls, name, port, reset_pin=None, keepalive=1, rx_timeout=None,
+             max_backoff=60, reset_after=2, reset_pulse=.1, reset_level=1,
+             gpio_root="/sys/class/gpio", reactor=reactor):
         local_light = cls()
         local_light.setLogger(logging.getLogger(name))
+        local_light.output = OutputScheduler(local_light, float(keepalive))
         serial = SerialPort(baudrate=cls.baud, deviceNameOrPortNumber=port,
                             protocol=local_light, reactor=reactor)
         local_light.setSerial(serial)
         local_light.setPort(port)
+        local_light.gpio_root = gpio_root
+        local_light.reset_after = int(reset_after)
+        local_light.reset_pulse = float(reset_pulse)
+        local_light.reset_level = int(reset_level)
         local_light.setReset(reset_pin)
         local_light.reactor = reactor
         local_light.sendUpdate()
-        #reactor.call_later(cls.rx_timeout, local_light.timed_out)
+        local_light.watchdog_loop = TimedLoopingCall(local_light.serviceWatchdog)
+        local_light.watchdog_loop.start(local_light.output.keepalive / 2, now=False).addErrback(log.err)
+        if rx_timeout is not None:
+            local_light.rx_timeout = float(rx_timeout)
+        local_light.max_backoff = float(max_backoff)
+        local_light.startSupervisor()
         return local_light
 
+    def startSupervisor(self):
+        self.opened = time()
+        # Time of the last status before the link was lost
+        self.lost_at = None
+        self.attempts = 0
+        self.next_attempt = 0
+        self.reopens = 0
+        self.resets = 0
+        self.recoveries = 0
+        self.last_recovery = None
+        self.recovery = Histogram(self.recovery_buckets)
+        self.supervise_loop = TimedLoopingCall(self.supervise)
+        self.supervise_loop.start(min(1, self.rx_timeout / 2), now=False).addErrback(log.err)
+
+    def supervise(self):
+        if self.lost_at is None:
+            if time() - max(self.last_seen, self.opened) <= self.rx_timeout:
+                return
+            self.linkLost("No status for {}s".format(self.rx_timeout))
+        if time() >= self.next_attempt:
+            self.recover()
+
+    def linkLost(self, reason):
+        self.logger.warning("{}, recovering link".format(reason))
+        self.lost_at = max(self.last_seen, self.opened)
+        self.attempts = 0
+        self.next_attempt = 0
+
+    def linkAlive(self):
+        '''
+        Called with every valid status, ends a recovery.
+        '''
+        if self.lost_at is None:
+            return
+        duration = time() - self.lost_at
+        self.recovery.observe(duration)
+        self.recoveries += 1
+        self.last_recovery = duration
+        self.logger.info("Link recovered after {:.1f}s and {} attempts".format(duration, self.attempts))
+        self.lost_at = None
+
+    def recover(self):
+        self.attempts += 1
+        if self.reset_name is not None and self.attempts % (self.reset_after + 1) == 0:
+            self.reset()
+        else:
+            self.reopen()
+        # Capped exponent, a long dead PIC would overflow the float
+        self.next_attempt = time() + min(self.max_backoff, self.rx_timeout * 2 ** min(self.attempts - 1, 16))
 
     def reopen(self):
         '''
         Tries to reestablish a serial link in case of HW issues
         '''
-        print(dir(self.serial))
+        self.reopens += 1
+        self.logger.info("Reopening {}".format(self.port))
+        try:
+            self.serial.loseConnection()
+        except Exception as e:
+            self.logger.debug("Closing {} failed: {}".format(self.port, e))
+        self.clearLineBuffer()
+        try:
+            self.serial = SerialPort(baudrate=self.baud, deviceNameOrPortNumber=self.port,
+                                     protocol=self, reactor=self.reactor)
+        except Exception as e:
+            self.logger.error("Reopening {} failed: {}".format(self.port, e))
+            return
+        self.resendCommands()
 
-        self.serial = SerialPort(baudrate=self.baud, deviceNameOrPortNumber=self.port,
-                            protocol=self, reactor=self.reactor)
+    def reset(self):
+        '''
+        Pulses the reset pin of the PIC, if there is one.
+        '''
+        if self.reset_name is None:
+            return
+        self.resets += 1
+        self.logger.info("Resetting the PIC")
+        self.writeGpio(self.reset_name, self.reset_level)
+        self.reactor.callLater(self.reset_pulse, self.resetDone)
+
+    def resetDone(self):
+        self.writeGpio(self.reset_name, 1 - self.reset_level)
+        self.resendCommands()
+
+    def resendCommands(self):
+        # The other side may have missed anything sent before
+        self.output.last_write = 0
+        self.sendUpdate()
+
+    def writeGpio(self, path, value):
+        try:
+            with open(path, "w") as f:
+                f.write("{}\n".format(value))
+        except OSError as e:
+            self.logger.error("Could not write {} to {}: {}".format(value, path, e))
 
     def lineLengthExceeded(self, line):
-        logging.error("Line length exceeded/codeDecodeErrorbaud rate error?")
-        print(self.serial)
-        self.serial.loseConnection()
-        self.serial.stopReading()
-        self.reactor.callLater(1, self.reopen)
-        #self.reopen()
+        self.logger.error("Line length exceeded, wrong baud rate?")
+        self.lines_garbled += 1
+        self.clearLineBuffer()
+        if self.lost_at is None:
+            self.linkLost("Line length exceeded")
+            # Not while the port is delivering data
+            self.reactor.callLater(0, self.supervise)
 
     def setPort(self, port):
         self.port = port
+        self.ports.add(port)
+
+    def retune(self, options):
+        if "keepalive" in options:
+            self.output.keepalive = float(options["keepalive"])
+            restart_loop(self.watchdog_loop, self.output.keepalive / 2, now=False)
+        if "rx_timeout" in options:
+            self.rx_timeout = float(options["rx_timeout"])
+            restart_loop(self.supervise_loop, min(1, self.rx_timeout / 2), now=False)
+        if "max_backoff" in options:
+            self.max_backoff = float(options["max_backoff"])
+        return set(options) - {"keepalive", "rx_timeout", "max_backoff"}
+
+    def stop(self):
+        stop_loop(self.watchdog_loop)
+        stop_loop(self.supervise_loop)
+        self.ports.discard(self.port)
+        self.serial.loseConnection()
 
     def setSerial(self, serial):
         self.serial = serial
@@ -610,23 +2499,28 @@ class TrafficLightSerial(basic.LineReceiver, TrafficLight):
             self.reset_name = None
             return
 
-        self.reset_name = "/sys/class/gpio/gpio{}/value".format(pin)
-        try:
-            with open("/sys/class/gpio/export", "w") as f:
-                f.write("{}\n".format(pin))
-        except Exception as e:
-            logging.error("Could not open/write exports in gpiofs: {}".format(e))
+        pin_root = os.path.join(self.gpio_root, "gpio{}".format(pin))
+        self.reset_name = os.path.join(pin_root, "value")
+        if not os.path.exists(pin_root):
+            self.writeGpio(os.path.join(self.gpio_root, "export"), pin)
+        self.writeGpio(os.path.join(pin_root, "direction"), "out")
+        self.writeGpio(self.reset_name, 1 - self.reset_level)
 
     def lineReceived(self, line):
         # Ignore blank lines
         if not line:
             return
+        self.lines_received += 1
         try:
             line = line.decode("ascii").strip()
             (self.state, self.batt_voltage, self.error_state, self.lamp_currents[0], self.lamp_currents[1], self.lamp_currents[2]) = line.split(" ")
             self.last_seen = time()
         except (ValueError, UnicodeDecodeError):
             logging.info("Received garbled line")
+            self.lines_garbled += 1
+            return
+        self.linkAlive()
+        self.publishState()
         # logging.warning("update myself: {}".format(self))
 
     def setConfig(self, param, value):
@@ -637,21 +2531,104 @@ class TrafficLightSerial(basic.LineReceiver, TrafficLight):
             raise ValueError("Unknown parameter {}".format(param))
 
     def sendUpdate(self):
-        if self.give_way:
-            self.sendLine("G".encode("ascii"))
-        else:
-            self.sendLine("g".encode("ascii"))
-        if self.temp_error:
-            self.sendLine("E".encode("ascii"))
-        else:
-            self.sendLine("e".encode("ascii"))
+        self.output.set("green", b"G" if self.give_way else b"g")
+        self.output.set("error", b"E" if self.temp_error else b"e")
 
     def serviceWatchdog(self):
-        self.sendUpdate()
+        self.output.refresh()
+
+    def statistics(self):
+        stats = TrafficLight.statistics(self)
+        stats.update({"lines": self.lines_received,
+                      "garbled": self.lines_garbled,
+                      "writes": self.output.writes,
+                      "recovering": self.lost_at is not None,
+                      "attempts": self.attempts,
+                      "reopens": self.reopens,
+                      "resets": self.resets,
+                      "recoveries": self.recoveries,
+                      "last_recovery": self.last_recovery,
+                      })
+        return stats
+
+    def metrics(self):
+        result = TrafficLight.metrics(self)
+        result.update({"serial_lines_total": self.lines_received,
+                       "serial_garbled_total": self.lines_garbled,
+                       "serial_writes_total": self.output.writes,
+                       "serial_writes_suppressed_total": self.output.suppressed,
+                       "serial_reopens_total": self.reopens,
+                       "serial_resets_total": self.resets,
+                       "serial_recovery_seconds": self.recovery,
+                       })
+        return result
+
+
+class TrafficLightSerialBinary(framing.FrameReceiver, TrafficLightSerial):
+    '''
+    Serial traffic light using binary frames with CRC (see
+    framing.py) instead of text lines.
+
+    The PIC is asked for frames with "b" along with the commands
+    at every keepalive and when it still sends text, e.g. after
+    a reset. Text status lines are accepted meanwhile.
+    '''
+    frames_lost = 0
+    last_seq = None
+    last_request = 0
+
+    def frameReceived(self, buffer, offset, length):
+        (self.state, self.batt_voltage, self.error_state,
+         self.lamp_currents[0], self.lamp_currents[1], self.lamp_currents[2],
+         seq) = framing.payload.unpack_from(buffer, offset)
+        if self.last_seq is not None:
+            self.frames_lost += (seq - self.last_seq - 1) % 256
+        self.last_seq = seq
+        self.last_seen = time()
+        self.linkAlive()
+        self.publishState()
+
+    def textLineReceived(self, line):
+        self.lineReceived(line.rstrip(b"\r"))
+        if time() - self.last_request > 1:
+            self.requestFrames()
+
+    def clearLineBuffer(self):
+        self.frame_buffer = None
+        return TrafficLightSerial.clearLineBuffer(self)
+
+    def requestFrames(self):
+        self.last_request = time()
+        self.sendLine(b"b")
+
+    def sendUpdate(self):
+        # Part of every keepalive, so a reset PIC switches back
+        self.output.set("mode", b"b")
+        TrafficLightSerial.sendUpdate(self)
+
+    def statistics(self):
+        stats = TrafficLightSerial.statistics(self)
+        stats.update({"frames": self.frames_received,
+                      "frames_garbled": self.frames_garbled,
+                      "frames_lost": self.frames_lost,
+                      })
+        return stats
+
+    def metrics(self):
+        result = TrafficLightSerial.metrics(self)
+        result.update({"serial_frames_total": self.frames_received,
+                       "serial_frames_garbled_total": self.frames_garbled,
+                       "serial_frames_lost_total": self.frames_lost,
+                       })
+        return result
 
 
 lightTypes = {'serial': TrafficLightSerial,
+              'serial_binary': TrafficLightSerialBinary,
               'group': TrafficLightGroup,
               'dummy': TrafficLightDummy,
               'remote': TrafficLightRemote,
+              'udp': TrafficLightUDP,
+              'fleet': TrafficLightFleet,
+              'junction': TrafficLightJunction,
               }
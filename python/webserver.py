@@ -1,9 +1,19 @@
 import json
+import math
+import hmac
+import hashlib
 import logging
+from functools import partial
+from time import time
 from configparser import SafeConfigParser
 from twisted.web.client import Agent, readBody
-from twisted.web import resource
-from twisted.internet import reactor, task
+from twisted.web import resource, server, http
+from twisted.internet import reactor, task, threads
+from twisted.python import log
+from auth import TransportWrapper
+from trafficlight import TrafficLight
+import metrics
+from monitor import TimedLoopingCall, Profiler
 
 
 class TrafficLightMasterSlave(object):
@@ -67,12 +77,61 @@ class TrafficLightMasterSlave(object):
         pass
 
 
+class LongPoll(object):
+    '''
+    A GET request which is held open until the state of
+    a traffic light changes or the timeout passes.
+    '''
+
+    def __init__(self, web, request, challenge, sealed, envelope, timeout):
+        self.web = web
+        self.request = request
+        self.challenge = challenge
+        self.sealed = sealed
+        self.envelope = envelope
+        self.finished = False
+        self.started = time()
+        # The timer first, on_change needs it
+        self.timer = reactor.callLater(timeout, self.answer)
+        self.web.myLight.subscribe(self.on_change)
+        request.notifyFinish().addErrback(self.on_lost)
+
+    def on_change(self, light):
+        # Answer at the end of this reactor turn, so all
+        # fields changed in this turn go out together.
+        if self.timer.active():
+            self.timer.reset(0)
+
+    def on_lost(self, failure):
+        self.finished = True
+        self.cleanup()
+
+    def cleanup(self):
+        if self.timer.active():
+            self.timer.cancel()
+        self.web.myLight.unsubscribe(self.on_change)
+
+    def answer(self):
+        self.cleanup()
+        if self.finished:
+            return
+        self.finished = True
+        # Lets the client tell holding time from round trip time
+        held = "{:.4f}".format(time() - self.started)
+        self.request.setHeader(b"x-held", held.encode('ascii'))
+        self.request.write(self.web.answer(self.request, self.challenge, self.sealed, self.envelope))
+        self.request.finish()
+
+
 class TrafficLightWeb(resource.Resource):
     isLeaf = True
     numberRequests = 0
+    # Longest time a "since" request is held open
+    max_hold = 30
 
-    def __init__(self, local_light):
+    def __init__(self, local_light, history=None):
         self.myLight = local_light
+        self.history = history
         print(local_light)
 
     # HTTP side
@@ -82,36 +141,117 @@ class TrafficLightWeb(resource.Resource):
         If the client sends a challenge, the whole
         packet will be signed using a transportWrapper
         from auth.py
+
+        The client may ask for the "compact" envelope
+        instead of the legacy JSON one.
+
+        With "auth=window" instead of a challenge the answer
+        is a sealed snapshot shared by all clients.
+
+        If the client passes the state version it already
+        knows as "since", the answer is held back until the
+        state changes or "timeout" seconds have passed.
         '''
+        if request.postpath and request.postpath[0]:
+            return self.render_subresource(request, request.postpath[0])
+
         challenge = None
         if b'challenge' in request.args:
             challenge = request.args[b'challenge'][0].decode('utf-8')
+        sealed = request.args.get(b'auth', [b''])[0] == b'window'
+        envelope = request.args.get(b'envelope', [b'json'])[0].decode('utf-8')
+        if envelope not in TransportWrapper.envelopes:
+            envelope = "json"
 
         self.numberRequests += 1
+        if b'since' in request.args:
+            try:
+                since = int(request.args[b'since'][0])
+                timeout = float(request.args.get(b'timeout', [self.max_hold])[0])
+                if not math.isfinite(timeout) or timeout < 0:
+                    raise ValueError("timeout out of range")
+            except ValueError:
+                request.setResponseCode(http.BAD_REQUEST)
+                return b"value error"
+            # Any other version (e.g. from before a restart)
+            # is answered right away.
+            if since == self.myLight.getSnapshot()[0]:
+                LongPoll(self, request, challenge, sealed, envelope, min(timeout, self.max_hold))
+                return server.NOT_DONE_YET
+
+        return self.answer(request, challenge, sealed, envelope)
+
+    def answer(self, request, challenge, sealed=False, envelope="json"):
         request.setHeader(b"content-type", b"text/plain")
-        content = self.myLight.to_json(challenge)
+        if sealed and self.myLight.transportWrapper is not None:
+            content = self.myLight.getSealedSnapshot(envelope)
+            request.setHeader(b"x-state-version", str(self.myLight.version).encode('ascii'))
+            return content
+        if challenge is not None:
+            content = self.myLight.to_json(challenge, envelope)
+            request.setHeader(b"x-state-version", str(self.myLight.version).encode('ascii'))
+            return content
+
+        # Unsigned answers are served from the pre-encoded
+        # snapshot, clients can revalidate using the ETag.
+        (version, content) = self.myLight.getSnapshot()
+        request.setHeader(b"x-state-version", str(version).encode('ascii'))
+        request.setHeader(b"cache-control", b"no-cache")
+        if request.setETag(self.etag(version)) == http.CACHED:
+            return b""
         return content
 
+    def render_subresource(self, request, name):
+        '''
+        Additional information about the light below its URL,
+        e.g. /interface/<name>/stats
+        '''
+        request.setHeader(b"content-type", b"application/json")
+        if name == b"history" and self.history is not None:
+            try:
+                since = float(request.args.get(b'from', [0])[0])
+                resolution = float(request.args.get(b'resolution', [0])[0])
+            except ValueError:
+                request.setResponseCode(http.BAD_REQUEST)
+                return b"value error"
+            if since < 0:
+                # Relative to now
+                since += time()
+            return bytes(json.dumps(self.history.history(since, resolution)).encode('utf8'))
+        if name == b"stats":
+            stats = self.myLight.statistics()
+            stats["web_requests"] = self.numberRequests
+            return bytes(json.dumps(stats).encode('utf8'))
+        request.setResponseCode(http.NOT_FOUND)
+        return b"not found"
+
+    def etag(self, version):
+        # The instance makes sure clients never get stale
+        # 304s from versions of an earlier run.
+        return '"{}-{}"'.format(self.myLight.instance, version).encode('ascii')
+
     def render_POST(self, request):
         data = request.args
         handled = False
         logging.debug("POST: {}".format(data))
+        if data.get(b'auth', [b''])[0] == b'sealed':
+            return self.render_push(request)
         # When no key is passed -> fail quickly
         try:
-            key = data[b'key'][0]
+            key = data[b'key'][0].decode('utf8', 'replace')
         except KeyError:
             key = None
             logging.debug("POST: No password")
 
         if not self.myLight.isWritable(key):
             logging.debug("POST: not writeable")
-            return "not writeable"
+            return b"not writeable"
 
         if b'giveway' in data:
             try:
                 value = int(data[b'giveway'][0])
             except:
-                return "value error"
+                return b"value error"
             self.myLight.setGreen(value)
             handled = True
 
@@ -124,6 +264,21 @@ class TrafficLightWeb(resource.Resource):
         else:
             return b"ok"
 
+    def render_push(self, request):
+        '''
+        A command pushed by the peer, sealed with the group key
+        (see trafficlight.CommandPush). Answers with the
+        acknowledgement.
+        '''
+        request.setHeader(b"content-type", b"application/json")
+        try:
+            ack = self.myLight.pushed(request.content.read())
+        except ValueError as e:
+            logging.warning("Push rejected: {}".format(e))
+            request.setResponseCode(http.FORBIDDEN)
+            return b"rejected"
+        return bytes(json.dumps(ack).encode('utf8'))
+
 
 class JSONAnswer(resource.Resource):
     isLeaf = False
@@ -136,3 +291,299 @@ class JSONAnswer(resource.Resource):
     # HTTP side
     def render_GET(self, request):
         return bytes(json.dumps(self.data).encode('utf8'))
+
+
+class TrafficLightStream(resource.Resource):
+    '''
+    Pushes the state of the traffic lights as server-sent
+    events, so clients don't have to poll.
+
+    Every light publishes its frames as event named after
+    the light, a frame is only sent when the published state
+    changes in more than the battery voltage. A "heartbeat" event is sent every heartbeat
+    seconds so clients can detect a dead connection.
+    Clients may restrict the stream to some lights by passing
+    one or more "name" arguments.
+    '''
+    isLeaf = True
+
+    def __init__(self, lights, heartbeat=5):
+        resource.Resource.__init__(self)
+        self.lights = lights
+        self.clients = []
+        # Name -> published state of the last frame, less voltage
+        self.streamed = {}
+        for name in lights:
+            self.watch(name, lights[name])
+        self.heartbeat_loop = TimedLoopingCall(self.heartbeat)
+        self.heartbeat_loop.start(heartbeat, now=False).addErrback(log.err)
+
+    def watch(self, name, light):
+        '''
+        Streams the changes of light, also used for lights
+        added on a reload.
+        '''
+        light.subscribe(partial(self.on_change, name))
+
+    def frame(self, event, data):
+        return b"event: " + event + b"\ndata: " + data + b"\n\n"
+
+    def render_GET(self, request):
+        if b'name' in request.args:
+            names = [x.decode('utf-8') for x in request.args[b'name']]
+        else:
+            names = list(self.lights.keys())
+        names = [x for x in names if x in self.lights]
+
+        request.setHeader(b"content-type", b"text/event-stream")
+        request.setHeader(b"cache-control", b"no-cache")
+        request.write(b"retry: 2000\n\n")
+        # Start with the current state of all requested lights
+        for name in names:
+            request.write(self.frame(name.encode('utf-8'),
+                                     self.lights[name].to_json(None)))
+
+        client = (request, set(names))
+        self.clients.append(client)
+        request.notifyFinish().addBoth(self.on_finish, client)
+        return server.NOT_DONE_YET
+
+    def on_finish(self, result, client):
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def on_change(self, name, light):
+        # The voltage changes with almost every reading
+        streamed = light.published[:1] + light.published[2:]
+        if self.streamed.get(name) == streamed:
+            return
+        self.streamed[name] = streamed
+        if not self.clients:
+            return
+        content = self.frame(name.encode('utf-8'), light.to_json(None))
+        for (request, wanted) in self.clients:
+            if name in wanted:
+                request.write(content)
+
+    def heartbeat(self):
+        # Liveness of a light depends on time, make sure
+        # a light that went stale gets published, too.
+        for name in self.lights:
+            self.lights[name].publishState()
+        content = self.frame(b"heartbeat", "{:.3f}".format(time()).encode('ascii'))
+        for (request, wanted) in self.clients:
+            request.write(content)
+
+
+class TrafficLightsAll(resource.Resource):
+    '''
+    State of all traffic lights (or those given as "name"
+    arguments) in one answer, as dict by name.
+
+    Supports the same signing as TrafficLightWeb, unsigned
+    answers are built from the lights' pre-encoded snapshots
+    and can be revalidated using the ETag.
+    '''
+    isLeaf = True
+    numberRequests = 0
+
+    def __init__(self, lights):
+        resource.Resource.__init__(self)
+        self.lights = lights
+        self.cache = {}
+        self.sealed = {}
+
+    def transportWrapper(self, names):
+        for name in names:
+            if self.lights[name].transportWrapper is not None:
+                return self.lights[name].transportWrapper
+        return None
+
+    def render_GET(self, request):
+        if b'name' in request.args:
+            names = set(x.decode('utf-8') for x in request.args[b'name'])
+            names = sorted(x for x in names if x in self.lights)
+        else:
+            names = sorted(self.lights.keys())
+        challenge = None
+        if b'challenge' in request.args:
+            challenge = request.args[b'challenge'][0].decode('utf-8')
+        sealed = request.args.get(b'auth', [b''])[0] == b'window'
+        envelope = request.args.get(b'envelope', [b'json'])[0].decode('utf-8')
+        if envelope not in TransportWrapper.envelopes:
+            envelope = "json"
+
+        self.numberRequests += 1
+        request.setHeader(b"content-type", b"text/plain")
+        snapshots = [(name, self.lights[name].getSnapshot()) for name in names]
+        versions = tuple((name, version) for (name, (version, content)) in snapshots)
+
+        wrapper = self.transportWrapper(names)
+        if challenge is not None and wrapper is not None:
+            data = {"lights": {name: self.lights[name].status() for name in names}}
+            return bytes(wrapper.encapsulate(challenge, data, envelope).encode('utf8'))
+        if sealed and wrapper is not None:
+            return self.getSealed(wrapper, names, versions, envelope)
+
+        # Only the latest answer per selection of lights is kept
+        cached = self.cache.get(tuple(names))
+        if cached is None or cached[0] != versions:
+            content = b"{" + b", ".join(json.dumps(name).encode('utf8') + b": " + snapshot
+                                        for (name, (version, snapshot)) in snapshots) + b"}"
+            key = ",".join("{}:{}".format(name, version) for (name, version) in versions)
+            etag = '"{}-{}"'.format(TrafficLight.instance,
+                                    hashlib.sha1(key.encode('utf8')).hexdigest()[:16])
+            cached = (versions, etag.encode('ascii'), content)
+            self.cache[tuple(names)] = cached
+        request.setHeader(b"cache-control", b"no-cache")
+        if request.setETag(cached[1]) == http.CACHED:
+            return b""
+        return cached[2]
+
+    def getSealed(self, wrapper, names, versions, envelope):
+        '''
+        Sealed answer, signed once per combination of states
+        (see TrafficLight.getSealedSnapshot).
+        '''
+        key = (tuple(names), envelope)
+        cached = self.sealed.get(key)
+        if cached is None or cached[0] != versions or time() - cached[1] > TrafficLight.reseal_interval:
+            data = {"lights": {name: self.lights[name].status() for name in names}}
+            # Versions only increase, so does their sum
+            seq = sum(version for (name, version) in versions)
+            content = wrapper.seal(data, seq, TrafficLight.instance, envelope)
+            cached = (versions, time(), bytes(content.encode('utf8')))
+            self.sealed[key] = cached
+        return cached[2]
+
+
+class TrafficLightMetrics(resource.Resource):
+    '''
+    Runtime metrics of all traffic lights in the Prometheus
+    text format. Counters and histograms are kept by the
+    lights (see TrafficLight.metrics) and only collected
+    when scraped.
+    '''
+    isLeaf = True
+
+    def __init__(self, lights, webs):
+        resource.Resource.__init__(self)
+        self.lights = lights
+        self.webs = webs
+
+    def render_GET(self, request):
+        samples = {}
+        for name in self.lights:
+            samples[name] = self.lights[name].metrics()
+            if name in self.webs:
+                samples[name]["web_requests_total"] = self.webs[name].numberRequests
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4")
+        return bytes(metrics.render(samples).encode('utf8'))
+
+
+class TrafficLightMonitor(resource.Resource):
+    '''
+    GET returns the reactor lag, callback timings and worst
+    offenders recorded by the monitor (see monitor.Monitor).
+
+    POST with the web API key as "key" samples the reactor
+    thread for "seconds" seconds and returns the profile as
+    collapsed stacks.
+    '''
+    isLeaf = True
+    max_seconds = 60
+
+    def __init__(self, monitor, key=None):
+        resource.Resource.__init__(self)
+        self.monitor = monitor
+        self.key = key
+        # Created in the reactor thread, which gets profiled
+        self.profiler = Profiler()
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"application/json")
+        return bytes(json.dumps(self.monitor.report()).encode('utf8'))
+
+    def render_POST(self, request):
+        key = request.args.get(b'key', [b''])[0]
+        if self.key is None or not hmac.compare_digest(key, self.key.encode('utf8')):
+            request.setResponseCode(http.FORBIDDEN)
+            return b"not allowed"
+        try:
+            seconds = float(request.args.get(b'seconds', [10])[0])
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST)
+            return b"value error"
+        seconds = min(max(seconds, 0), self.max_seconds)
+        request.setHeader(b"content-type", b"text/plain")
+        # Set when the client goes away while sampling
+        lost = []
+        request.notifyFinish().addErrback(lost.append)
+        d = threads.deferToThread(self.profiler.run, seconds)
+        d.addCallback(self.on_profile, request, lost)
+        d.addErrback(self.on_profile_error, request, lost)
+        return server.NOT_DONE_YET
+
+    def on_profile(self, stacks, request, lost):
+        if lost:
+            return
+        if stacks is None:
+            request.setResponseCode(http.CONFLICT)
+            request.write(b"another profile is running")
+        else:
+            request.write(bytes(Profiler.format(stacks).encode('utf8')))
+        request.finish()
+
+    def on_profile_error(self, failure, request, lost):
+        log.err(failure)
+        if not lost:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.finish()
+
+
+class TrafficLightReload(resource.Resource):
+    '''
+    GET returns the report of the last reload of the config
+    (see lightconfig.LightConfig.reload).
+
+    POST with the web API key as "key" reloads the config and
+    answers with the report once the affected lights are good
+    again.
+    '''
+    isLeaf = True
+
+    def __init__(self, config, key=None):
+        resource.Resource.__init__(self)
+        self.config = config
+        self.key = key
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"application/json")
+        return bytes(json.dumps(self.config.last_reload).encode('utf8'))
+
+    def render_POST(self, request):
+        key = request.args.get(b'key', [b''])[0]
+        if self.key is None or not hmac.compare_digest(key, self.key.encode('utf8')):
+            request.setResponseCode(http.FORBIDDEN)
+            return b"not allowed"
+        request.setHeader(b"content-type", b"application/json")
+        lost = []
+        request.notifyFinish().addErrback(lost.append)
+        d = self.config.reload()
+        d.addCallback(self.on_reloaded, request, lost)
+        d.addErrback(self.on_reload_error, request, lost)
+        return server.NOT_DONE_YET
+
+    def on_reloaded(self, report, request, lost):
+        if lost:
+            return
+        if "error" in report:
+            request.setResponseCode(http.BAD_REQUEST)
+        request.write(bytes(json.dumps(report).encode('utf8')))
+        request.finish()
+
+    def on_reload_error(self, failure, request, lost):
+        log.err(failure)
+        if not lost:
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            request.finish()
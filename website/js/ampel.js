@@ -1,3 +1,12 @@
+// The picture of a traffic light, fetched once for all panels
+picture_request = null;
+picture = function(){
+	if (picture_request === null){
+		picture_request = $.ajax("/image/ampel.svg", {dataType: "text"});
+	}
+	return picture_request;
+}
+
 traffic_light = function (subdir, root_element) {
 	let me = this;
 	this.error_count = 0;
@@ -27,7 +36,7 @@ traffic_light = function (subdir, root_element) {
 		};
 	this.error=function(textStatus){
 		me.error_count++;
-		if (me.error_count>4){
+		if (me.error_count>4 && me.red_circle !== undefined){
 			me.red_circle.hide();
 			me.yellow_circle.hide();
 			me.green_circle.hide();
@@ -35,25 +44,58 @@ traffic_light = function (subdir, root_element) {
 	};
 	this.got_answer=function(data){
 		me.error_count = 0;
+		me.last_data = data;
+		// Picture not loaded yet, will be shown once it arrived
+		if (me.red_circle === undefined) return;
 		$(".battvoltage", me.root_element).val(data.batt_voltage/100.0);
+		me.add_battery_point(Date.now()/1000, data.batt_voltage);
 		if (data.lamp_currents[0]>10) me.red_circle.show(); else me.red_circle.hide();
 		if (data.lamp_currents[1]>10) me.yellow_circle.show(); else me.yellow_circle.hide();
 		if (data.lamp_currents[2]>10) me.green_circle.show(); else me.green_circle.hide();
 
 	};
-	$.ajax("/image/ampel.svg",
-		{
-		dataType:"text",
-		success:function(data){
+	// Battery curve of the last hour, from the history
+	// once and extended by every state received.
+	this.batt_points = [];
+	this.add_battery_point=function(t, voltage){
+		let points = me.batt_points;
+		if (points.length > 0 && t - points[points.length-1][0] < 10) return;
+		points.push([t, voltage]);
+		while (points.length > 0 && points[0][0] < t - 3600) points.shift();
+		me.draw_battery();
+	};
+	this.draw_battery=function(){
+		let points = me.batt_points;
+		let curve = $(".battcurve polyline", me.root_element);
+		if (points.length < 2 || curve.length == 0) return;
+		let values = points.map(function(p){ return p[1]; });
+		let low = Math.min.apply(null, values);
+		let high = Math.max.apply(null, values);
+		let t0 = points[0][0];
+		let span = Math.max(points[points.length-1][0] - t0, 1);
+		curve.attr("points", points.map(function(p){
+			let x = 100 * (p[0] - t0) / span;
+			let y = (high > low) ? 20 - 20 * (p[1] - low) / (high - low) : 10;
+			return x.toFixed(1) + "," + y.toFixed(1);
+		}).join(" "));
+	};
+	$.ajax(me.subdir + "/history?from=-3600&resolution=10", {
+		dataType: "json",
+		success: function(data){
+			let known = me.batt_points;
+			me.batt_points = data.time.map(function(t, i){
+				return [t, data.batt_voltage.mean[i]];
+			}).concat(known);
+			me.draw_battery();
+		},
+	});
+	picture().done(function(data){
 			$(".tlpicture", me.root_element).replaceWith(data);
 			me.red_circle = $(".red", me.root_element);
 			me.yellow_circle = $(".yellow", me.root_element);
 			me.green_circle = $(".green", me.root_element);
 			me.error_count = 0;
-            // Now finally run the stuff after loading
-            me.run(250);
-			},
-		
+			if (me.last_data !== undefined) me.got_answer(me.last_data);
 		});
 	$(".setred",this.root_element).click( function(){
 		me.set_way(0);
@@ -67,7 +109,67 @@ traffic_light = function (subdir, root_element) {
 	});
 }
 
-traffic_lights=[];
+// Receives the state of all lights as server-sent events,
+// falls back to polling all lights at once if the browser can't.
+state_stream = function (lights, heartbeat) {
+	let me = this;
+	this.lights = lights;
+	this.last_event = Date.now();
+	this.error=function(textStatus){
+		for (var name in me.lights) me.lights[name].error(textStatus);
+	};
+	this.connect=function(){
+		me.source = new EventSource("/interface/_stream");
+		me.last_event = Date.now();
+		for (var name in me.lights){
+			let light = me.lights[name];
+			me.source.addEventListener(name, function(event){
+				me.last_event = Date.now();
+				light.got_answer(JSON.parse(event.data));
+			});
+		}
+		me.source.addEventListener("heartbeat", function(event){
+			me.last_event = Date.now();
+		});
+		me.source.onerror = function(){
+			me.error("stream");
+		};
+	};
+	// A silently dropped connection is not noticed by the
+	// browser, reconnect when heartbeats stop arriving.
+	this.watchdog=function(){
+		if (Date.now() - me.last_event > 3*heartbeat){
+			me.error("timeout");
+			me.source.close();
+			me.connect();
+		}
+		window.setTimeout(me.watchdog, heartbeat);
+	};
+	// Without server-sent events, get all lights in one request per tick
+	this.poll=function(interval){
+		$.ajax("/interface/_all", {
+			dataType: "json",
+			timeout: interval,
+			success: function(data){
+				for (var name in data){
+					if (name in me.lights) me.lights[name].got_answer(data[name]);
+				}
+			},
+			error: function(jqXHR, textStatus, errorThrown){
+				me.error(textStatus);
+			}
+		});
+		window.setTimeout(function(){me.poll(interval);}, interval);
+	};
+	if (typeof(EventSource) === "undefined"){
+		this.poll(250);
+		return;
+	}
+	this.connect();
+	window.setTimeout(me.watchdog, heartbeat);
+}
+
+traffic_lights={};
 $("document").ready(function()
 {
 	$.ajax("/interface",
@@ -82,9 +184,10 @@ $("document").ready(function()
                 let name = data[x];
                 let local_copy = skel.clone();
                 local_copy.attr("id", name);
-                new traffic_light("/interface/"+name, local_copy);
+                traffic_lights[name] = new traffic_light("/interface/"+name, local_copy);
                 section.append(local_copy);
             }
+            new state_stream(traffic_lights, 5000);
 		},
 	});
 });